@@ -0,0 +1,55 @@
+"""
+Per-call encode / decode cost of the registered JSON codecs.
+
+Run from the repository root:
+
+    python benchmarks/codec_benchmark.py
+"""
+
+import datetime
+import timeit
+
+from bson import ObjectId
+
+from jsonrpclib.codec import registry
+
+ROUNDS = 2000
+
+plain_payload = {
+    'jsonrpc': '2.0', 'id': 'a0l976iv',
+    'result': [
+        {'name': 'item%d' % i, 'price': i * 1.5, 'tags': ['a', 'b'],
+         'active': True, 'parent': None}
+        for i in range(100)
+    ]
+}
+
+special_payload = {
+    'jsonrpc': '2.0', 'id': 'a0l976iv',
+    'result': [
+        {'_id': ObjectId(), 'created': datetime.datetime(2015, 1, 1),
+         'name': 'item%d' % i}
+        for i in range(100)
+    ]
+}
+
+
+def bench(label, func):
+    seconds = timeit.timeit(func, number=ROUNDS)
+    print '%-28s %8.1f us/call' % (label, seconds / ROUNDS * 1000000)
+
+
+def main():
+    for payload_name, payload in (('plain', plain_payload),
+                                  ('special', special_payload)):
+        for codec_name in sorted(registry.keys()):
+            codec = registry[codec_name]
+            data = codec.dumps(payload)
+            bench('%s dumps (%s)' % (codec_name, payload_name),
+                  lambda: codec.dumps(payload))
+            bench('%s loads (%s)' % (codec_name, payload_name),
+                  lambda: codec.loads(data))
+
+
+if __name__ == '__main__':
+    main()
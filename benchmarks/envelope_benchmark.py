@@ -0,0 +1,61 @@
+"""
+Cost of building the request / response envelopes: dumps (which fills
+in a template for the version) against encoding a whole Payload dict,
+as dumps used to.
+
+Run from the repository root:
+
+    python benchmarks/envelope_benchmark.py
+"""
+
+import timeit
+
+import jsonrpclib
+from jsonrpclib import jsonrpc
+
+COUNT = 100000
+ROUNDS = 3
+
+params = [5, 6]
+result = {'sum': 11}
+
+
+def payload_request():
+    return jsonrpc.jdumps(
+        jsonrpc.Payload(rpcid='abcd1234').request('add', params))
+
+
+def payload_response():
+    return jsonrpc.jdumps(jsonrpc.Payload(rpcid='abcd1234').response(result))
+
+
+def payload_error():
+    return jsonrpc.jdumps(
+        jsonrpc.Payload(rpcid='abcd1234').error(-32601, 'Method not found'))
+
+
+def envelope_request():
+    return jsonrpclib.dumps(params, 'add', rpcid='abcd1234')
+
+
+def envelope_response():
+    return jsonrpclib.dumps(result, methodresponse=True, rpcid='abcd1234')
+
+
+def envelope_error():
+    return jsonrpc.Fault(-32601, 'Method not found').response('abcd1234')
+
+
+def bench(label, func):
+    seconds = min(timeit.repeat(func, number=COUNT, repeat=ROUNDS))
+    print '%-24s %6.2f us' % (label, seconds * 1000000 / COUNT)
+
+
+def main():
+    for name in ('request', 'response', 'error'):
+        bench('payload %s' % name, globals()['payload_%s' % name])
+        bench('envelope %s' % name, globals()['envelope_%s' % name])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Cost of class translation (jsonclass.dump / load) on a response with
+100k nested objects, with and without __jsonclass__ entries in it.
+
+Run from the repository root:
+
+    python benchmarks/jsonclass_benchmark.py
+"""
+
+import timeit
+
+import jsonrpclib
+from jsonrpclib import jsonclass
+
+COUNT = 100000
+ROUNDS = 3
+
+
+class Item(object):
+
+    def __init__(self, name=None, price=None):
+        self.name = name
+        self.price = price
+        self.tags = ['a', 'b']
+
+# Dumped as a bare class name, since this runs as __main__
+jsonrpclib.config.classes.add(Item)
+
+plain_result = [
+    {'name': 'item%d' % i, 'price': i * 1.5,
+     'detail': {'tags': ['a', 'b'], 'active': True}}
+    for i in range(COUNT)
+]
+
+object_result = [Item('item%d' % i, i * 1.5) for i in range(COUNT)]
+
+
+def bench(label, func):
+    seconds = min(timeit.repeat(func, number=1, repeat=ROUNDS))
+    print '%-36s %8.1f ms' % (label, seconds * 1000)
+
+
+def main():
+    for name, result in (('plain', plain_result),
+                         ('objects', object_result)):
+        dumped = jsonclass.dump(result)
+        data = jsonrpclib.dumps(result, methodresponse=True, rpcid=1)
+        bench('jsonclass.dump (%s)' % name, lambda: jsonclass.dump(result))
+        bench('jsonrpclib.dumps (%s)' % name,
+              lambda: jsonrpclib.dumps(result, methodresponse=True, rpcid=1))
+        bench('jsonclass.load (%s)' % name, lambda: jsonclass.load(dumped))
+        bench('jsonrpclib.loads (%s)' % name, lambda: jsonrpclib.loads(data))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+"""
+A single-threaded, event driven JSON-RPC server on top of asyncore,
+for serving lots of (mostly idle) keep-alive connections from one
+process. Requests are validated and dispatched exactly like on the
+SimpleJSONRPCServer.
+
+Handlers run on the event loop, so they must not block. A handler
+that has to wait for something can return a jsonrpclib.workers.Future
+instead of a value -- the response is sent once the Future is done,
+and the loop keeps serving other connections in the meantime:
+
+    from jsonrpclib.AsyncJSONRPCServer import AsyncJSONRPCServer
+    from jsonrpclib.workers import WorkerPool
+
+    pool = WorkerPool(max_workers=20)
+    server = AsyncJSONRPCServer(('localhost', 8080))
+    server.register_function(lambda x, y: x + y, 'add')
+    server.register_function(
+        lambda url: pool.submit(fetch, url), 'fetch')
+    server.serve_forever()
+"""
+
+import asynchat
+import asyncore
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import jsonrpclib
+from jsonrpclib import Fault
+from jsonrpclib.jsonrpc import USE_UNIX_SOCKETS
+from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCDispatcher
+from jsonrpclib.workers import Future
+
+
+class EpollLoop(object):
+    """
+    Runs the dispatchers of a socket map on epoll. Unlike asyncore's
+    poll loops, which ask every dispatcher whether it's readable or
+    writable on every iteration, this only re-checks the ones that were
+    touched (had an event, were created, pushed data...) since, so idle
+    connections cost nothing.
+    """
+
+    def __init__(self, map):
+        self.map = map
+        self.epoll = select.epoll()
+        self.masks = {}
+        self.dirty = set()
+
+    def touch(self, fd):
+        self.dirty.add(fd)
+
+    def poll(self, timeout):
+        dirty, self.dirty = self.dirty, set()
+        for fd in dirty:
+            self._update(fd)
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return
+            raise
+        for fd, event in events:
+            obj = self.map.get(fd)
+            if obj is None:
+                continue
+            # The EPOLL* flags have the same values as the POLL* ones
+            asyncore.readwrite(obj, event)
+            self.dirty.add(fd)
+
+    def _update(self, fd):
+        obj = self.map.get(fd)
+        old_mask = self.masks.get(fd)
+        if obj is None:
+            if old_mask is not None:
+                del self.masks[fd]
+                try:
+                    self.epoll.unregister(fd)
+                except (IOError, ValueError):
+                    # Closing the fd already unregistered it
+                    pass
+            return
+        mask = 0
+        if obj.readable():
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if obj.writable() and not obj.accepting:
+            mask |= select.EPOLLOUT
+        if mask == old_mask:
+            return
+        if old_mask is not None:
+            try:
+                self.epoll.modify(fd, mask)
+            except IOError, e:
+                # The fd was closed and reused since it was registered
+                if e.errno != errno.ENOENT:
+                    raise
+                self.epoll.register(fd, mask)
+        else:
+            self.epoll.register(fd, mask)
+        self.masks[fd] = mask
+
+    def close(self):
+        self.epoll.close()
+
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Wakes the event loop up from other threads, to run callbacks on it.
+    """
+
+    def __init__(self, map):
+        self.callbacks = deque()
+        self.lock = threading.Lock()
+        self.wake_up_fd = None
+        read_fd, self.wake_up_fd = os.pipe()
+        flags = fcntl.fcntl(self.wake_up_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.wake_up_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, map=map)
+        os.close(read_fd)
+
+    def call(self, callback):
+        self.callbacks.append(callback)
+        with self.lock:
+            if self.wake_up_fd is None:
+                return
+            try:
+                os.write(self.wake_up_fd, 'x')
+            except OSError, e:
+                # A full pipe will wake the loop up all the same
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        while self.callbacks:
+            callback = self.callbacks.popleft()
+            try:
+                callback()
+            except Exception:
+                logging.exception('Callback on the event loop failed.')
+
+    def close(self):
+        with self.lock:
+            if self.wake_up_fd is not None:
+                os.close(self.wake_up_fd)
+                self.wake_up_fd = None
+        asyncore.file_dispatcher.close(self)
+
+
+class AsyncJSONRPCChannel(asynchat.async_chat):
+    """ One HTTP/1.1 connection to the AsyncJSONRPCServer. """
+
+    def __init__(self, server, sock, client_address):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.client_address = client_address
+        self.requests_handled = 0
+        self.pending = False
+        self.closing = False
+        self.last_activity = time.time()
+        self._reset()
+        self.server.touch(self._fileno)
+
+    def _reset(self):
+        self.buffer = []
+        self.command = None
+        self.headers = None
+        self.set_terminator('\r\n\r\n')
+
+    def readable(self):
+        # One request at a time -- don't read the next one before
+        # this one's response is on its way.
+        return not self.pending and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        if self.closing:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        if self.headers is None:
+            if not self.parse_request(data):
+                return
+            length = int(self.headers.get('content-length', 0) or 0)
+            if length:
+                self.set_terminator(length)
+                return
+            data = ''
+        self.handle_request(data)
+
+    def parse_request(self, data):
+        lines = data.lstrip('\r\n').split('\r\n')
+        words = lines[0].split()
+        if len(words) != 3:
+            self.send_error(400, 'Bad request')
+            return False
+        self.command, self.path, self.request_version = words
+        self.headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        if self.command != 'POST':
+            self.send_error(501, 'Unsupported method (%r)' % self.command)
+            return False
+        if self.server.rpc_paths and self.path not in self.server.rpc_paths:
+            self.send_error(404, 'No such page')
+            return False
+        try:
+            length = int(self.headers.get('content-length', 0) or 0)
+        except ValueError:
+            self.send_error(400, 'Bad content length')
+            return False
+        max_size = self.server.max_request_size
+        if max_size and length > max_size:
+            self.send_error(413, 'Request entity too large')
+            return False
+        return True
+
+    def handle_request(self, data):
+        self.requests_handled += 1
+        self.pending = True
+        try:
+            batch, responses = self.server._marshaled_dispatch_entries(data)
+        except Exception:
+            err_lines = traceback.format_exc().splitlines()
+            trace_string = '%s | %s' % (err_lines[-3], err_lines[-1])
+            fault = Fault(-32603, 'Server error: %s' % trace_string)
+            self.send_response(500, fault.response())
+            return
+        futures = [resp for resp in responses if isinstance(resp, Future)]
+        if not futures:
+            self.send_response(
+                200, self.server._join_responses(batch, responses))
+            return
+
+        waiting = [len(futures)]
+
+        def resolved(future):
+            waiting[0] -= 1
+            if waiting[0]:
+                return
+            results = [resp.result() if isinstance(resp, Future) else resp
+                       for resp in responses]
+            results = [resp for resp in results if resp is not None]
+            self.send_response(
+                200, self.server._join_responses(batch, results))
+
+        for future in futures:
+            future.add_done_callback(
+                lambda future: self.server.call_soon(
+                    lambda: resolved(future)))
+
+    def keep_connection(self):
+        if not self.server.keep_alive:
+            return False
+        max_requests = self.server.max_keep_alive_requests
+        if max_requests and self.requests_handled >= max_requests:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.request_version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def send_response(self, code, response):
+        if not self.connected:
+            # The client went away while the response was computed
+            return
+        if response is None:
+            response = ''
+        keep = code == 200 and self.keep_connection()
+        headers = [
+            'HTTP/1.1 %d %s' % (code, code == 200 and 'OK' or 'Error'),
+            'Content-Type: application/json-rpc',
+            'Content-Length: %d' % len(response),
+            'Connection: %s' % (keep and 'keep-alive' or 'close'),
+        ]
+        self.push('%s\r\n\r\n%s' % ('\r\n'.join(headers), response))
+        self.last_activity = time.time()
+        self.pending = False
+        if keep:
+            self._reset()
+        else:
+            self.close_when_done()
+        self.server.touch(self._fileno)
+
+    def send_error(self, code, message):
+        # Whatever else was sent (the rejected body, maybe with a
+        # \r\n\r\n in it) is dropped unread
+        self.closing = True
+        self.set_terminator(None)
+        self.ac_in_buffer = ''
+        self.buffer = []
+        self.pending = True
+        self.push('HTTP/1.1 %d %s\r\nContent-Type: text/plain\r\n'
+                  'Content-Length: %d\r\nConnection: close\r\n\r\n%s' %
+                  (code, message, len(message), message))
+        self.close_when_done()
+        self.server.touch(self._fileno)
+
+    def close(self):
+        fd = self._fileno
+        asynchat.async_chat.close(self)
+        self.server.touch(fd)
+
+    def handle_error(self):
+        exc_type = sys.exc_info()[0]
+        if exc_type is socket.error:
+            # Reset by peer and the like
+            self.close()
+            return
+        logging.exception('Error on connection from %s.',
+                          self.client_address)
+        self.close()
+
+
+class Acceptor(asyncore.dispatcher):
+
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        # The socket is already listening (see dispatcher.listen)
+        self.accepting = True
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                logging.warning('Out of file descriptors, not accepting.')
+                return
+            raise
+        if pair is None:
+            return
+        sock, client_address = pair
+        self.server.channel_class(self.server, sock, client_address)
+
+    def writable(self):
+        return False
+
+    def handle_error(self):
+        logging.exception('Error accepting a connection.')
+
+
+class AsyncJSONRPCServer(SimpleJSONRPCDispatcher):
+
+    allow_reuse_address = True
+    request_queue_size = 128
+    rpc_paths = ('/', '/RPC2')
+    channel_class = AsyncJSONRPCChannel
+    keep_alive = True
+    # Idle connections cost next to nothing here, so they're kept.
+    keep_alive_timeout = 60
+    # Seconds an idle connection is kept open.
+    max_keep_alive_requests = None
+    # Requests served on one connection before it's closed (None for
+    # no limit).
+    max_request_size = None
+    # Largest request body accepted, in bytes (None for no limit).
+    loop = None
+    # An EpollLoop where epoll is available, otherwise asyncore's own
+    # poll() based loop is used.
+
+    def __init__(self, addr, logRequests=False, encoding=None,
+                 bind_and_activate=True, address_family=socket.AF_INET):
+        SimpleJSONRPCDispatcher.__init__(self, encoding)
+        self.logRequests = logRequests
+        self.address_family = address_family
+        self.server_address = addr
+        self.socket_map = {}
+        self._stopping = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+        self.socket = socket.socket(address_family, socket.SOCK_STREAM)
+        if USE_UNIX_SOCKETS and address_family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                try:
+                    os.unlink(addr)
+                except OSError:
+                    logging.warning("Could not unlink socket %s", addr)
+        if bind_and_activate:
+            self.server_bind()
+            self.server_activate()
+
+    def server_bind(self):
+        if self.allow_reuse_address:
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+        self.acceptor = Acceptor(self, self.socket)
+        self.trigger = Trigger(self.socket_map)
+        if hasattr(select, 'epoll'):
+            self.loop = EpollLoop(self.socket_map)
+            self.touch(self.acceptor._fileno)
+            self.touch(self.trigger._fileno)
+
+    def touch(self, fd):
+        """ Has the event loop re-check what a dispatcher waits for. """
+        if self.loop is not None:
+            self.loop.touch(fd)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def call_soon(self, callback):
+        """ Runs callback on the event loop; safe from any thread. """
+        self.trigger.call(callback)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._stopping = False
+        self._is_shut_down.clear()
+        last_sweep = time.time()
+        try:
+            while not self._stopping:
+                if self.loop is not None:
+                    self.loop.poll(poll_interval)
+                else:
+                    asyncore.loop(timeout=poll_interval, use_poll=True,
+                                  map=self.socket_map, count=1)
+                now = time.time()
+                if now - last_sweep >= 1:
+                    self.close_idle_channels(now)
+                    last_sweep = now
+        finally:
+            self._is_shut_down.set()
+
+    def close_idle_channels(self, now=None):
+        if now is None:
+            now = time.time()
+        deadline = now - self.keep_alive_timeout
+        for channel in self.socket_map.values():
+            if isinstance(channel, AsyncJSONRPCChannel) and \
+                    not channel.pending and channel.last_activity < deadline:
+                channel.close()
+
+    def shutdown(self):
+        self._stopping = True
+        self.call_soon(lambda: None)
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        for dispatcher in self.socket_map.values():
+            dispatcher.close()
+        self.socket_map.clear()
+        self.socket.close()
+        if self.loop is not None:
+            self.loop.close()
+
+    def _marshaled_response(self, request, response):
+        if not isinstance(response, Future):
+            return SimpleJSONRPCDispatcher._marshaled_response(
+                self, request, response)
+        if 'id' not in request.keys() or request['id'] is None:
+            # Notifications don't wait for anything
+            return None
+        marshaled = Future()
+
+        def done(future):
+            try:
+                result = future.result()
+            except:
+                err_lines = traceback.format_exception(
+                    *sys.exc_info())
+                err_lines = ''.join(err_lines).splitlines()
+                trace_string = '%s | %s' % (err_lines[-3], err_lines[-1])
+                result = jsonrpclib.Fault(-32603, 'Server error: %s' %
+                                          trace_string)
+            marshaled.set_result(SimpleJSONRPCDispatcher._marshaled_response(
+                self, request, result))
+
+        response.add_done_callback(done)
+        return marshaled
@@ -1,14 +1,25 @@
 import jsonrpclib
 from jsonrpclib import Fault
-from jsonrpclib.jsonrpc import USE_UNIX_SOCKETS
+from jsonrpclib.cache import ResponseCache, MISSING
+from jsonrpclib.jsonrpc import USE_UNIX_SOCKETS, isnotification
+from jsonrpclib.jsonrpc import RawJSON, encode_result
+from jsonrpclib.stream import BatchSplitter
+from jsonrpclib.workers import Future, WorkerPool, PoolFull, SingleFlight
 import SimpleXMLRPCServer
 import SocketServer
+import multiprocessing
+import threading
+import select
+import signal
 import socket
 import logging
+import errno
 import os
+import time
 import types
 import traceback
 import sys
+from collections import deque
 try:
     import fcntl
 except ImportError:
@@ -51,46 +62,229 @@ def validate_request(request):
 
 class SimpleJSONRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
 
+    batch_workers = None
+    # Size of the thread pool that batch entries and notifications are
+    # dispatched on. None runs batch entries one after the other, and
+    # notifications before the response is sent.
+    max_batch_concurrency = None
+    # Entries of a single batch running at once (None for no limit
+    # besides batch_workers).
+    batch_pool = None
+    cache_size = 1024
+    # Results kept for the methods registered with a cache_ttl (or
+    # decorated with jsonrpclib.cache.cached)...
+    cache_max_bytes = 64*1024*1024
+    # ... and the most memory their serialized text may take up.
+    response_cache = None
+    # Built from the two above when a cached method is first called,
+    # unless a ResponseCache is set here before.
+
     def __init__(self, encoding=None):
         SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__init__(
             self, allow_none=True, encoding=encoding)
+        self._batch_pool_lock = threading.Lock()
+        self._response_cache_lock = threading.Lock()
+        self.cache_ttls = {}
+        self.coalesced_methods = set()
+        self.single_flight = SingleFlight()
+
+    def register_function(self, function, name=None, cache_ttl=None,
+                          coalesce=False):
+        """
+        Registers a function, like SimpleXMLRPCServer does. With a
+        cache_ttl, its serialized results are kept in response_cache
+        for that many seconds, and repeated calls with the same params
+        are answered from there. With coalesce, identical calls that
+        come in while one is running wait for it and share its result,
+        instead of running again.
+        """
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.register_function(
+            self, function, name)
+        if name is None:
+            name = function.__name__
+        if cache_ttl:
+            self.cache_ttls[name] = cache_ttl
+        else:
+            self.cache_ttls.pop(name, None)
+        if coalesce:
+            self.coalesced_methods.add(name)
+        else:
+            self.coalesced_methods.discard(name)
 
     def _marshaled_dispatch(self, data, dispatch_method=None):
-        response = None
+        return self._collect_responses(
+            *self._marshaled_dispatch_entries(data))
+
+    def _marshaled_dispatch_stream(self, chunks):
+        """
+        Like _marshaled_dispatch, for a request given as an iterable of
+        chunks of text. Entries of a batch are dispatched as soon as
+        they've been read, instead of once the whole batch is decoded.
+        """
+        return self._collect_responses(
+            *self._marshaled_stream_entries(chunks))
+
+    def _collect_responses(self, batch, responses):
+        responses = [
+            resp.result() if isinstance(resp, Future) else resp
+            for resp in responses]
+        if batch:
+            responses = [resp for resp in responses if resp is not None]
+        return self._join_responses(batch, responses)
+
+    def _marshaled_dispatch_entries(self, data, lazy=False):
+        """
+        Returns whether the request was a batch, and the list of
+        marshaled responses (notifications have none). With lazy, that
+        list may be an iterator, dispatching each entry of a batch as
+        it gets to it.
+        """
         try:
             request = jsonrpclib.loads(data)
         except Exception, e:
             fault = Fault(-32700, 'Request %s invalid. (%s)' % (data, e))
-            response = fault.response()
-            return response
+            return False, [fault.response()]
         if not request:
             fault = Fault(-32600, 'Request invalid -- no request data.')
-            return fault.response()
+            return False, [fault.response()]
         if isinstance(request, list):
             # This SHOULD be a batch, by spec
-            responses = []
-            for req_entry in request:
-                result = validate_request(req_entry)
-                if type(result) is Fault:
-                    responses.append(result.response())
-                    continue
-                resp_entry = self._marshaled_single_dispatch(req_entry)
-                if resp_entry is not None:
-                    responses.append(resp_entry)
-            if len(responses) > 0:
-                response = '[%s]' % ','.join(responses)
-            else:
-                response = ''
-        else:
-            result = validate_request(request)
+            return True, self._marshaled_batch_entries(request, lazy)
+        result = validate_request(request)
+        if type(result) is Fault:
+            return False, [result.response()]
+        if self.batch_workers and isnotification(request):
+            # Nobody waits for a notification
+            self._get_batch_pool().submit(
+                self._marshaled_single_dispatch, request)
+            return False, [None]
+        return False, [self._marshaled_single_dispatch(request)]
+
+    def _marshaled_stream_entries(self, chunks):
+        """
+        _marshaled_dispatch_entries for a request read in chunks. Only
+        batches are split up; anything else is decoded in one go.
+        """
+        chunks = iter(chunks)
+        splitter = BatchSplitter()
+        elements = []
+        try:
+            for chunk in chunks:
+                elements.extend(splitter.feed(chunk))
+                if splitter.is_array is not None:
+                    break
+        except ValueError, e:
+            fault = Fault(-32700, 'Request invalid. (%s)' % e)
+            return False, [fault.response()]
+        if not splitter.is_array:
+            return self._marshaled_dispatch_entries(
+                splitter.document + ''.join(chunks))
+
+        def requests():
+            for element in elements:
+                yield jsonrpclib.loads(element)
+            for chunk in chunks:
+                for element in splitter.feed(chunk):
+                    yield jsonrpclib.loads(element)
+            for element in splitter.close():
+                yield jsonrpclib.loads(element)
+
+        try:
+            responses = self._marshaled_batch_entries(requests())
+        except Exception, e:
+            # Entries before the broken one have run already
+            fault = Fault(-32700, 'Request invalid. (%s)' % e)
+            return False, [fault.response()]
+        if not splitter.count:
+            fault = Fault(-32600, 'Request invalid -- no request data.')
+            return False, [fault.response()]
+        return True, responses
+
+    def _marshaled_batch_entries(self, requests, lazy=False):
+        if self.batch_workers:
+            return self._marshaled_batch_dispatch(requests)
+        responses = self._iter_batch_entries(requests)
+        if lazy:
+            return responses
+        return list(responses)
+
+    def _iter_batch_entries(self, requests):
+        for req_entry in requests:
+            result = validate_request(req_entry)
             if type(result) is Fault:
-                return result.response()
-            response = self._marshaled_single_dispatch(request)
-        return response
+                yield result.response()
+                continue
+            resp_entry = self._marshaled_single_dispatch(req_entry)
+            if resp_entry is not None:
+                yield resp_entry
+
+    def _get_response_cache(self):
+        with self._response_cache_lock:
+            if self.response_cache is None:
+                self.response_cache = ResponseCache(
+                    self.cache_size, max_bytes=self.cache_max_bytes)
+            return self.response_cache
+
+    def _get_batch_pool(self):
+        with self._batch_pool_lock:
+            if self.batch_pool is None:
+                self.batch_pool = WorkerPool(
+                    self.batch_workers, name='%s-batch' %
+                    self.__class__.__name__)
+            return self.batch_pool
+
+    def _marshaled_batch_dispatch(self, requests):
+        """
+        Runs the entries of a batch on the batch pool and returns their
+        responses in order, as Futures. Notifications run too, but
+        aren't waited for. Entries start as soon as requests yields
+        them, so it can be a generator still reading the batch.
+        """
+        pool = self._get_batch_pool()
+        limit = self.max_batch_concurrency
+        responses = []
+        entries = deque()
+        lock = threading.Lock()
+        runners = [0]
+
+        def run_entries():
+            while True:
+                with lock:
+                    if not entries:
+                        runners[0] -= 1
+                        return
+                    req_entry, future = entries.popleft()
+                try:
+                    future.set_result(
+                        self._marshaled_single_dispatch(req_entry))
+                except:
+                    future.set_exception()
+
+        for req_entry in requests:
+            result = validate_request(req_entry)
+            if type(result) is Fault:
+                responses.append(result.response())
+                continue
+            future = Future()
+            with lock:
+                entries.append((req_entry, future))
+                start = not limit or runners[0] < limit
+                if start:
+                    runners[0] += 1
+            if start:
+                pool.submit(run_entries)
+            if not isnotification(req_entry):
+                responses.append(future)
+        return responses
+
+    def _join_responses(self, batch, responses):
+        if not batch:
+            return responses[0]
+        if len(responses) > 0:
+            return '[%s]' % ','.join(responses)
+        return ''
 
     def _marshaled_single_dispatch(self, request):
-        # TODO - Use the multiprocessing and skip the response if
-        # it is a notification
         # Put in support for custom dispatcher here
         # (See SimpleXMLRPCServer._marshaled_dispatch)
         method = request.get('method')
@@ -101,6 +295,9 @@ class SimpleJSONRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
             exc_type, exc_value, exc_tb = sys.exc_info()
             fault = Fault(-32603, '%s:%s' % (exc_type, exc_value))
             return fault.response()
+        return self._marshaled_response(request, response)
+
+    def _marshaled_response(self, request, response):
         if 'id' not in request.keys() or request['id'] is None:
             # It's a notification
             return None
@@ -133,44 +330,181 @@ class SimpleJSONRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
                     except AttributeError:
                         pass
         if func is not None:
-            try:
-                if isinstance(params, types.ListType):
-                    response = func(*params)
-                else:
-                    response = func(**params)
-                return response
-            # except TypeError:
-            #     return Fault(-32602, 'Invalid parameters.')
-            except:
-                err_lines = traceback.format_exc().splitlines()
-                trace_string = '%s | %s' % (err_lines[-3], err_lines[-1])
-                fault = jsonrpclib.Fault(-32603, 'Server error: %s' %
-                                         trace_string)
-                return fault
+            return self._call_method(func, method, params)
         else:
             return Fault(-32601, 'Method %s not supported.' % method)
 
+    def _call(self, func, params):
+        try:
+            if isinstance(params, types.ListType):
+                response = func(*params)
+            else:
+                response = func(**params)
+            return response
+        # except TypeError:
+        #     return Fault(-32602, 'Invalid parameters.')
+        except:
+            err_lines = traceback.format_exc().splitlines()
+            trace_string = '%s | %s' % (err_lines[-3], err_lines[-1])
+            fault = jsonrpclib.Fault(-32603, 'Server error: %s' %
+                                     trace_string)
+            return fault
+
+    def _call_method(self, func, method, params):
+        """
+        _call, answered from response_cache and / or coalesced with
+        the identical calls running at the same time, if the method is
+        cached / coalesced.
+        """
+        ttl = self.cache_ttls.get(method) or getattr(func, 'cache_ttl', None)
+        coalesce = method in self.coalesced_methods or \
+            getattr(func, 'coalesce', False)
+        if not ttl and not coalesce:
+            return self._call(func, params)
+        cache = self._get_response_cache()
+        key = cache.key(method, params)
+        if key is None:
+            return self._call(func, params)
+        if ttl:
+            response = cache.get(key, MISSING)
+            if response is not MISSING:
+                return response
+        if coalesce:
+            return self.single_flight.call(
+                key, self._coalesced_call, func, params, key, ttl)
+        return self._fresh_call(func, params, key, ttl)
+
+    def _coalesced_call(self, func, params, key, ttl):
+        """
+        _fresh_call, unless an identical call that finished between the
+        cache lookup and the single flight has cached its result.
+        """
+        if ttl:
+            # Already counted as a miss by _call_method
+            response = self._get_response_cache().get(
+                key, MISSING, count=False)
+            if response is not MISSING:
+                return response
+        return self._fresh_call(func, params, key, ttl)
+
+    def _fresh_call(self, func, params, key, ttl):
+        """
+        _call, with the result cached for ttl seconds if there's one.
+        It's cached already serialized (as RawJSON), so a hit isn't
+        encoded again either. Faults and Futures aren't cached.
+        """
+        response = self._call(func, params)
+        if not ttl or isinstance(response, (Fault, Future)):
+            return response
+        try:
+            text = encode_result(response)
+        except:
+            # Left for _marshaled_response to report
+            return response
+        response = RawJSON(text)
+        self._get_response_cache().set(key, response, ttl, size=len(text))
+        return response
+
 
 class SimpleJSONRPCRequestHandler(
         SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
 
+    # HTTP/1.1 so that clients can keep the connection open between
+    # requests -- whether they're allowed to is up to the server's
+    # keep_alive, keep_alive_timeout and max_keep_alive_requests.
+    protocol_version = 'HTTP/1.1'
+    requests_handled = 0
+    stream_chunk_size = 64*1024
+    # Request bodies larger than this are read and parsed a chunk at a
+    # time, and the entries of a batch dispatched while the rest of it
+    # is still coming in.
+
+    def setup(self):
+        if getattr(self.server, 'keep_alive', False):
+            # Doubles as the idle timeout between two requests
+            self.timeout = self.server.keep_alive_timeout
+        if USE_UNIX_SOCKETS and \
+                getattr(self.server, 'address_family', None) == socket.AF_UNIX:
+            # TCP_NODELAY can't be set on Unix sockets
+            self.disable_nagle_algorithm = False
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """
+        Waits for the next request on a kept-alive connection, up to the
+        idle timeout. On a pooled server, gives up early (closing the
+        connection) when woken up for a connection waiting for a worker.
+        """
+        wakeup = getattr(self.server, 'wakeup', None)
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if self.timeout is None or wakeup is None or \
+                (rbuf is not None and rbuf.tell()):
+            # Left to the socket's timeout
+            return True
+        deadline = time.time() + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                readable = select.select(
+                    [self.connection, wakeup], [], [], remaining)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    # The server is closing
+                    return False
+                continue
+            if self.connection in readable:
+                return True
+            if readable and self.server.take_wakeup(wakeup):
+                return False
+
+    def keep_connection(self):
+        if not getattr(self.server, 'keep_alive', False):
+            return False
+        max_requests = self.server.max_keep_alive_requests
+        if max_requests and self.requests_handled >= max_requests:
+            return False
+        if getattr(self.server, 'backlog', 0):
+            # Other connections are waiting for a worker, make room
+            return False
+        return not self.close_connection
+
     def do_POST(self):
         if not self.is_rpc_path_valid():
             self.report_404()
             return
+        self.requests_handled += 1
         try:
-            max_chunk_size = 10*1024*1024
             size_remaining = int(self.headers["content-length"])
-            L = []
-            while size_remaining:
-                chunk_size = min(size_remaining, max_chunk_size)
-                L.append(self.rfile.read(chunk_size))
-                size_remaining -= len(L[-1])
-            data = ''.join(L)
-            response = self.server._marshaled_dispatch(data)
+            max_size = getattr(self.server, 'max_request_size', None)
+            if max_size and size_remaining > max_size:
+                self.report_too_large()
+                return
+            if size_remaining > self.stream_chunk_size:
+                batch, responses = self.server._marshaled_stream_entries(
+                    self.read_chunks(size_remaining))
+            else:
+                data = ''.join(self.read_chunks(size_remaining))
+                batch, responses = self.server._marshaled_dispatch_entries(
+                    data, lazy=True)
+            if batch and self.request_version == 'HTTP/1.1' and \
+                    getattr(self.server, 'chunked_batches', False):
+                self.send_batch(responses)
+                return
+            response = self.server._collect_responses(batch, responses)
             self.send_response(200)
         except Exception:
             self.send_response(500)
+            # The body may not have been read, so the connection
+            # can't be used for another request.
+            self.close_connection = 1
             err_lines = traceback.format_exc().splitlines()
             trace_string = '%s | %s' % (err_lines[-3], err_lines[-1])
             fault = jsonrpclib.Fault(-32603, 'Server error: %s' % trace_string)
@@ -179,15 +513,119 @@ class SimpleJSONRPCRequestHandler(
             response = ''
         self.send_header("Content-type", "application/json-rpc")
         self.send_header("Content-length", str(len(response)))
+        if self.keep_connection():
+            self.send_header("Connection", "keep-alive")
+        else:
+            self.send_header("Connection", "close")
         self.end_headers()
         self.wfile.write(response)
         self.wfile.flush()
-        self.connection.shutdown(1)
+
+    def send_batch(self, responses):
+        """
+        Sends the responses of a batch with chunked transfer encoding,
+        each one as soon as it's ready (those that are ready together
+        going in one chunk of up to stream_chunk_size).
+        """
+        self.send_response(200)
+        self.send_header("Content-type", "application/json-rpc")
+        self.send_header("Transfer-Encoding", "chunked")
+        if self.keep_connection():
+            self.send_header("Connection", "keep-alive")
+        else:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        ready = []
+        size = 0
+        separator = '['
+        try:
+            for response in responses:
+                if isinstance(response, Future):
+                    if ready and not response.done():
+                        self.write_chunk(''.join(ready))
+                        ready = []
+                        size = 0
+                    response = response.result()
+                if response is None:
+                    continue
+                ready.append(separator)
+                ready.append(response)
+                separator = ','
+                size += len(response) + 1
+                if size >= self.stream_chunk_size:
+                    self.write_chunk(''.join(ready))
+                    ready = []
+                    size = 0
+        except Exception:
+            # Too late for an error response. Leaving out the last chunk
+            # tells the client the response is incomplete.
+            logging.exception('Batch response cut short.')
+            self.close_connection = 1
+            return
+        if separator == ',':
+            ready.append(']')
+        self.write_chunk(''.join(ready), last=True)
+
+    def write_chunk(self, data, last=False):
+        chunk = data and '%X\r\n%s\r\n' % (len(data), data) or ''
+        if last:
+            chunk += '0\r\n\r\n'
+        self.wfile.write(chunk)
+        self.wfile.flush()
+
+    def read_chunks(self, size_remaining):
+        while size_remaining:
+            chunk = self.rfile.read(
+                min(size_remaining, self.stream_chunk_size))
+            if not chunk:
+                # The client hung up
+                return
+            size_remaining -= len(chunk)
+            yield chunk
+
+    def report_too_large(self):
+        # Refused before reading any of the body, which is left unread
+        self.send_response(413)
+        response = jsonrpclib.Fault(
+            -32600, 'Request larger than %d bytes.' %
+            self.server.max_request_size).response()
+        self.send_header("Content-type", "application/json-rpc")
+        self.send_header("Content-length", str(len(response)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(response)
+        self.close_connection = 1
+
+    def report_404(self):
+        # The request body is left unread, so don't reuse the connection
+        self.send_response(404)
+        response = 'No such page'
+        self.send_header("Content-type", "text/plain")
+        self.send_header("Content-length", str(len(response)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(response)
 
 
 class SimpleJSONRPCServer(SocketServer.TCPServer, SimpleJSONRPCDispatcher):
 
     allow_reuse_address = True
+    keep_alive = False
+    # Keep HTTP/1.1 connections open between requests. Off by default,
+    # since this server handles one connection at a time and an idle
+    # client would otherwise block everyone else until it times out.
+    keep_alive_timeout = 15
+    # Seconds an idle persistent connection is kept open.
+    max_keep_alive_requests = 100
+    # Requests served on one connection before it's closed (None for
+    # no limit).
+    max_request_size = None
+    # Largest request body accepted, in bytes (None for no limit).
+    # Bigger ones are refused with a 413 before any of it is read.
+    chunked_batches = True
+    # Send the responses to a batch as they're ready, with chunked
+    # transfer encoding (to HTTP/1.1 clients), instead of joining them
+    # all before sending any.
 
     def __init__(self, addr, requestHandler=SimpleJSONRPCRequestHandler,
                  logRequests=True, encoding=None, bind_and_activate=True,
@@ -219,6 +657,398 @@ class SimpleJSONRPCServer(SocketServer.TCPServer, SimpleJSONRPCDispatcher):
             fcntl.fcntl(self.fileno(), fcntl.F_SETFD, flags)
 
 
+class BusyServer(object):
+    """
+    Stands in for the real server when a connection is turned away, so
+    the request handler reads the request as usual but answers it with
+    a "server busy" fault and closes the connection.
+    """
+    keep_alive = False
+
+    def __init__(self, server):
+        self._server = server
+
+    def __getattr__(self, name):
+        return getattr(self._server, name)
+
+    def _marshaled_dispatch_entries(self, data, lazy=False):
+        fault = Fault(-32001, 'Server busy, try again later.')
+        return False, [fault.response()]
+
+    def _marshaled_stream_entries(self, chunks):
+        for chunk in chunks:
+            pass
+        return self._marshaled_dispatch_entries(None)
+
+
+class RejectMixIn:
+    """
+    Answers connections the server has no room for. (Like SocketServer's
+    mix-ins, this is an old-style class so that it can go in front of
+    TCPServer in the bases.)
+    """
+    reject_timeout = 1
+    # Seconds the acceptor spends reading a request it turns away.
+
+    def reject_request(self, request, client_address):
+        request.settimeout(self.reject_timeout)
+        try:
+            self.RequestHandlerClass(
+                request, client_address, BusyServer(self))
+        except Exception:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+
+class PoolMixIn(RejectMixIn):
+    """
+    Handles connections on a bounded pool of threads. Once max_workers
+    connections are being served and max_queue more are waiting,
+    new connections get a "server busy" fault.
+    """
+    max_workers = 32
+    # Connections handled concurrently (kept-alive ones included).
+    max_queue = 64
+    # Accepted connections waiting for a worker (0 for no limit).
+    pool = None
+    wakeup = None
+    # Read end of a pipe with a byte in it for each connection queued
+    # for a worker, so that one idle kept-alive connection gives its
+    # worker up.
+    closing = False
+
+    @property
+    def backlog(self):
+        if self.pool is None:
+            return 0
+        return self.pool.qsize()
+
+    def process_request(self, request, client_address):
+        if self.pool is None:
+            self.pool = WorkerPool(self.max_workers, self.max_queue,
+                                   name=self.__class__.__name__)
+            if fcntl is not None:
+                # (Otherwise idle connections just time out)
+                self.wakeup, self._wakeup_write = os.pipe()
+                for fd in (self.wakeup, self._wakeup_write):
+                    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        try:
+            self.pool.submit(
+                self.process_request_thread, request, client_address)
+        except PoolFull:
+            self.reject_request(request, client_address)
+            return
+        if self.wakeup is not None and self.pool.qsize():
+            self._wake_up(1)
+
+    def _wake_up(self, count):
+        try:
+            os.write(self._wakeup_write, 'x' * count)
+        except OSError, e:
+            # Full of wake-ups already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def take_wakeup(self, wakeup):
+        """
+        Whether this idle worker is the one woken up (all of them are,
+        once the server is closing).
+        """
+        if self.closing:
+            return True
+        try:
+            return bool(os.read(wakeup, 1))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EBADF):
+                # Another one was
+                return False
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.closing = True
+        pool, self.pool = self.pool, None
+        if pool is None:
+            return
+        if self.wakeup is None:
+            pool.shutdown(wait=False)
+            return
+        # Left unread, so it lets go of every idle connection
+        self._wake_up(1)
+
+        def close_wakeup():
+            # Not before the workers waiting on it are gone
+            pool.shutdown()
+            wakeup, self.wakeup = self.wakeup, None
+            os.close(wakeup)
+            os.close(self._wakeup_write)
+        thread = threading.Thread(
+            target=close_wakeup, name='%s-close' % self.__class__.__name__)
+        thread.daemon = True
+        thread.start()
+
+
+class ThreadedJSONRPCServer(PoolMixIn, SimpleJSONRPCServer):
+    """
+    Serves each connection on a thread from a bounded pool, so a slow
+    method only holds up its own client.
+    """
+    keep_alive = True
+
+
+class ForkingJSONRPCServer(RejectMixIn, SocketServer.ForkingMixIn,
+                           SimpleJSONRPCServer):
+    """
+    Serves each connection in a child process, with at most
+    max_children of them running at once; connections beyond that
+    get a "server busy" fault instead of waiting.
+    """
+    keep_alive = True
+    keep_alive_timeout = 2
+    # Short, since a child can't tell whether connections are waiting
+    # for it, and holds its slot while idle.
+    max_children = 40
+
+    def process_request(self, request, client_address):
+        if self.active_children and \
+                len(self.active_children) >= self.max_children:
+            self.reap_children()
+            if len(self.active_children) >= self.max_children:
+                self.reject_request(request, client_address)
+                return
+        SocketServer.ForkingMixIn.process_request(
+            self, request, client_address)
+
+    def reap_children(self):
+        """ Like collect_children, but never blocks. """
+        for pid in list(self.active_children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                # Already collected
+                done = pid
+            if done:
+                self.active_children.discard(pid)
+
+
+class PreforkMixIn:
+    """
+    Binds once in the master process, then forks `workers` processes
+    which all accept connections on that socket. The master restarts
+    workers that die, replaces all of them on SIGHUP (graceful reload)
+    and stops them on SIGTERM / SIGINT, giving each up to
+    graceful_timeout seconds to finish what it's doing.
+
+    Goes in front of SimpleJSONRPCServer, or ThreadedJSONRPCServer to
+    run a thread pool in every worker.
+    """
+    workers = None
+    # Number of worker processes (None for one per CPU).
+    reuse_port = False
+    # Give each worker its own listening socket bound with SO_REUSEPORT,
+    # so the kernel spreads connections between them. TCP only, and
+    # like allow_reuse_address it's used when binding, so set it on
+    # the class.
+    graceful_timeout = 30
+    # Seconds a stopping worker gets before it's killed.
+    respawn_delay = 1
+    # Minimum lifetime of a worker before it's restarted straight away,
+    # so that a worker crashing on startup doesn't spin the master.
+    children = None
+    _stopping = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            if getattr(socket, 'SO_REUSEPORT', None) is None:
+                raise ValueError('SO_REUSEPORT is not available.')
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        SocketServer.TCPServer.server_bind(self)
+
+    def server_activate(self):
+        # With reuse_port, the master just holds on to the address and
+        # the workers listen on their own sockets.
+        if not self.reuse_port:
+            SocketServer.TCPServer.server_activate(self)
+
+    def worker_init(self):
+        """ Called in every worker after the fork. """
+        pass
+
+    def serve_forever(self, poll_interval=0.5):
+        self._stopping = False
+        self._reload_requested = False
+        self._generation = 0
+        self.children = {}
+        previous_handlers = {}
+        for signum, handler in ((signal.SIGTERM, self._handle_stop),
+                                (signal.SIGINT, self._handle_stop),
+                                (signal.SIGHUP, self._handle_reload)):
+            previous_handlers[signum] = signal.signal(signum, handler)
+        try:
+            self._spawn_workers(poll_interval)
+            while not self._stopping:
+                if self._reload_requested:
+                    self._reload(poll_interval)
+                self._reap_workers(poll_interval)
+                time.sleep(poll_interval)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self._stop_workers(self.children.keys())
+
+    def shutdown(self):
+        self._stopping = True
+
+    def reload(self):
+        self._reload_requested = True
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def _spawn_workers(self, poll_interval):
+        workers = self.workers or multiprocessing.cpu_count()
+        for i in range(workers):
+            self._spawn_worker(poll_interval)
+
+    def _spawn_worker(self, poll_interval):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (self._generation, time.time())
+            return pid
+        status = 1
+        try:
+            self._run_worker(poll_interval)
+            status = 0
+        except Exception:
+            logging.exception('Worker %d failed.', os.getpid())
+        finally:
+            os._exit(status)
+
+    def _run_worker(self, poll_interval):
+        self.children = None
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        # Don't let the signal break off a request being handled
+        signal.siginterrupt(signal.SIGTERM, False)
+        # Ctrl-C goes to the whole process group, let the master handle it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self.reuse_port:
+            self._open_worker_socket()
+        # Another worker may win the race for a connection, so accept()
+        # mustn't block.
+        self.socket.setblocking(0)
+        self.worker_init()
+        while not self._stopping:
+            try:
+                ready = select.select([self], [], [], poll_interval)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if ready:
+                self._handle_request_noblock()
+        pool = getattr(self, 'pool', None)
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _open_worker_socket(self):
+        sock = socket.socket(self.address_family, self.socket_type)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.server_address)
+        sock.listen(self.request_queue_size)
+        self.socket.close()
+        self.socket = sock
+
+    def _reap_workers(self, poll_interval):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self.children.clear()
+                    break
+                raise
+            if not pid:
+                break
+            generation, started = self.children.pop(pid, (None, None))
+            if generation != self._generation or self._stopping:
+                # Replaced by a reload, or on its way out
+                continue
+            if os.WIFSIGNALED(status):
+                logging.warning('Worker %d killed by signal %d, restarting.',
+                                pid, os.WTERMSIG(status))
+            else:
+                logging.warning('Worker %d exited with code %d, restarting.',
+                                pid, os.WEXITSTATUS(status))
+            if time.time() - started < self.respawn_delay:
+                time.sleep(self.respawn_delay)
+            self._spawn_worker(poll_interval)
+
+    def _reload(self, poll_interval):
+        self._reload_requested = False
+        old_workers = self.children.keys()
+        self._generation += 1
+        self._spawn_workers(poll_interval)
+        for pid in old_workers:
+            self._signal_worker(pid, signal.SIGTERM)
+
+    def _signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _stop_workers(self, pids):
+        for pid in pids:
+            self._signal_worker(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        remaining = set(pids)
+        while remaining:
+            for pid in list(remaining):
+                try:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    # Already collected
+                    done = pid
+                if done:
+                    remaining.discard(pid)
+                    self.children.pop(pid, None)
+            if remaining and time.time() > deadline:
+                for pid in remaining:
+                    logging.warning('Killing worker %d.', pid)
+                    self._signal_worker(pid, signal.SIGKILL)
+                deadline = time.time() + self.graceful_timeout
+            if remaining:
+                time.sleep(0.05)
+
+
+class PreforkJSONRPCServer(PreforkMixIn, SimpleJSONRPCServer):
+    """
+    SimpleJSONRPCServer running in several processes, all sharing one
+    listening socket (TCP or Unix).
+    """
+    pass
+
+
 class CGIJSONRPCRequestHandler(SimpleJSONRPCDispatcher):
 
     def __init__(self, encoding=None):
@@ -3,4 +3,7 @@ config = Config.instance()
 from jsonrpclib.history import History
 history = History.instance()
 from jsonrpclib.jsonrpc import Server, MultiCall, Fault
+from jsonrpclib.jsonrpc import AsyncServerProxy, BatchingServerProxy
+from jsonrpclib.jsonrpc import RawJSON
+from jsonrpclib.cache import ResponseCache
 from jsonrpclib.jsonrpc import ProtocolError, loads, dumps
@@ -0,0 +1,202 @@
+"""
+Caching of call results, for read methods that are called over and
+over with the same params.
+
+A ResponseCache maps (method, params) to a result for a while: each
+entry expires after its method's TTL, and the least recently used ones
+are dropped once there are more than max_size. Give one to a
+ServerProxy to answer repeated calls without going to the server:
+
+>>> cache = jsonrpclib.ResponseCache(
+...     methods={'config.get': 300, 'catalog.lookup': 30})
+>>> server = jsonrpclib.Server('http://localhost:8080', cache=cache)
+>>> server.config.get('timeout')   # asks the server
+>>> server.config.get('timeout')   # answered from the cache
+>>> cache.invalidate('config.get')
+
+On the server, methods registered with a cache_ttl (or decorated with
+cached) keep their serialized results in the dispatcher's cache.
+"""
+
+import collections
+import threading
+import time
+
+
+class ResponseCache(object):
+    """
+    A thread safe TTL / LRU cache of call results. Only the methods in
+    methods (a dict of method name to TTL in seconds, or None for the
+    default ttl) are cached, or every method if it's None. Faults and
+    other errors are never cached. With max_bytes, the least recently
+    used entries are also dropped once the sizes given to set add up
+    to more than that.
+
+    The cached results are handed out as they are, so they shouldn't
+    be modified by the caller.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, methods=None, max_bytes=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.methods = methods
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._entries = collections.OrderedDict()
+        # [hits, misses] by method
+        self._method_stats = {}
+        self._lock = threading.Lock()
+
+    def method_ttl(self, method):
+        """ The TTL of the method, or None if it isn't cached. """
+        if self.methods is None:
+            return self.ttl
+        if method not in self.methods:
+            return None
+        ttl = self.methods[method]
+        if ttl is None:
+            return self.ttl
+        return ttl
+
+    def key(self, method, params):
+        """
+        The cache key of a call, or None if the params can't be used
+        as one (the order of keyword params doesn't matter).
+        """
+        try:
+            return (method, freeze(params))
+        except TypeError:
+            return None
+
+    def get(self, key, default=None, count=True):
+        """
+        The cached value of key, or default. Without count, the lookup
+        isn't counted as a hit or miss (for a second look at a key).
+        """
+        with self._lock:
+            counts = self._method_stats.get(key[0])
+            if counts is None:
+                counts = self._method_stats[key[0]] = [0, 0]
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self.size_bytes -= entry[2]
+                if count:
+                    self.misses += 1
+                    counts[1] += 1
+                return default
+            # Back to the most recently used end
+            self._entries[key] = entry
+            if count:
+                self.hits += 1
+                counts[0] += 1
+            return entry[1]
+
+    def set(self, key, value, ttl, size=0):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size_bytes -= entry[2]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (time.time() + ttl, value, size)
+            self.size_bytes += size
+            while len(self._entries) > self.max_size or \
+                    (self.max_bytes is not None and
+                     self.size_bytes > self.max_bytes):
+                self.size_bytes -= self._entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def call(self, method, params, request):
+        """
+        The cached result of the call if there is one, otherwise the
+        result of request(), which is cached if the method is.
+        """
+        ttl = self.method_ttl(method)
+        if not ttl:
+            return request()
+        key = self.key(method, params)
+        if key is None:
+            return request()
+        result = self.get(key, MISSING)
+        if result is MISSING:
+            result = request()
+            self.set(key, result, ttl)
+        return result
+
+    def invalidate(self, method=None, params=None):
+        """
+        Drops the entry of one call, every entry of a method (if params
+        is None), or everything (if method is None too).
+        """
+        with self._lock:
+            if method is None:
+                self._entries.clear()
+                self.size_bytes = 0
+                return
+            if params is not None:
+                keys = [self.key(method, params)]
+            else:
+                keys = [key for key in self._entries if key[0] == method]
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.size_bytes -= entry[2]
+
+    def stats(self, method=None):
+        """
+        The hits, misses, evictions and size (in entries and bytes) of
+        the cache, or the hits and misses of one method.
+        """
+        with self._lock:
+            if method is not None:
+                hits, misses = self._method_stats.get(method, (0, 0))
+                return {'hits': hits, 'misses': misses}
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._entries),
+                    'bytes': self.size_bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Stands in for a cache miss, since None is a valid result
+MISSING = object()
+
+
+def cached(ttl=60):
+    """
+    Marks a function or method served by a SimpleJSONRPCServer as
+    cacheable: its serialized results are kept for ttl seconds, by
+    params, in the dispatcher's response_cache.
+
+    >>> class Catalog(object):
+    ...     @cached(ttl=30)
+    ...     def lookup(self, sku):
+    ...         return db.find(sku)
+    """
+    def decorate(function):
+        function.cache_ttl = ttl
+        return function
+    return decorate
+
+
+def freeze(value):
+    """
+    A hashable equivalent of JSON params. Raises TypeError for values
+    that can't be hashed.
+    """
+    kind = type(value)
+    if kind is list or kind is tuple:
+        return tuple([freeze(item) for item in value])
+    if kind is dict:
+        return (dict, tuple(sorted(
+            [(name, freeze(item)) for name, item in value.iteritems()])))
+    if kind is bool or kind is float:
+        # Otherwise True, 1 and 1.0 would be the same key
+        return (kind, value)
+    hash(value)
+    return value
@@ -0,0 +1,188 @@
+"""
+JSON codec backends used by jsonrpc.jdumps / jsonrpc.jloads.
+
+The backend is picked by name from config.codec on every call, so it
+can be switched at runtime. Two codecs are registered by default:
+
+* 'fast' -- the C-accelerated encoder / scanner, only calling into
+  bson.json_util when a special type (ObjectId, datetime...) or an
+  extended JSON document ({"$oid": ...}, {"$date": ...}) is seen.
+* 'bson' -- always goes through bson.json_util.dumps / loads.
+
+Other backends need a dumps(obj, default=None) and a
+loads(data, object_hook=None) method, and can be added with
+register_codec(). The default hook is called for every object the
+encoder can't serialize itself, and the object_hook on every decoded
+dict (innermost first); both return what goes in its place, which is
+how jsonclass translation happens while encoding / decoding.
+
+Backends with only dumps(obj) and loads(data) are wrapped in a
+PlainCodec, which translates with jsonclass.dump / load in a separate
+pass instead.
+"""
+
+import inspect
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from bson import json_util
+
+from jsonrpclib import config
+from jsonrpclib import jsonclass
+
+# Every extended JSON key ($oid, $date, $numberLong...) starts like this
+EXTENDED_JSON_MARKER = '"$'
+
+registry = {}
+
+
+def bson_fallback(obj):
+    """
+    What bson.json_util.dumps makes of an object: mappings become dicts
+    and other iterables (sets, generators...) lists, before trying
+    json_util.default.
+    """
+    if hasattr(obj, 'iteritems') or hasattr(obj, 'items'):
+        return dict(obj.items())
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    return json_util.default(obj)
+
+
+def bson_default(default=None):
+    """
+    default if given, falling back to bson.json_util's conversions for
+    the objects it refuses with a TypeError.
+    """
+    if default is None:
+        return bson_fallback
+
+    def hook(obj):
+        try:
+            return default(obj)
+        except TypeError:
+            return bson_fallback(obj)
+    return hook
+
+
+def bson_object_hook(object_hook=None):
+    """ bson.json_util's object hook, followed by object_hook if given. """
+    if object_hook is None:
+        return json_util.object_hook
+
+    def hook(dct):
+        obj = json_util.object_hook(dct)
+        if isinstance(obj, dict):
+            return object_hook(obj)
+        # An ObjectId, datetime...
+        return obj
+    return hook
+
+
+class BSONCodec(object):
+    """
+    Always runs the bson.json_util hooks, which walk every single
+    object in Python whether or not it needs converting.
+    """
+
+    def dumps(self, obj, default=None):
+        if default is None:
+            return json_util.dumps(obj)
+        # What default returns isn't converted by json_util beforehand
+        return json_util.dumps(obj, default=bson_default(default))
+
+    def loads(self, data, object_hook=None):
+        if object_hook is None:
+            return json_util.loads(data)
+        return json.loads(data, object_hook=bson_object_hook(object_hook))
+
+
+class FastCodec(object):
+    """
+    Plain payloads are handled entirely by the C encoder / scanner.
+    The encoder only calls bson_fallback for the objects it can't
+    serialize itself, and the bson object hook is only used if the
+    document actually contains an extended JSON key.
+    """
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(default=bson_fallback)
+        self.decoder = json.JSONDecoder()
+        # Encoders by default hook, decoders by object hook
+        self.hooked_encoders = {}
+        self.hooked_decoders = {}
+
+    def dumps(self, obj, default=None):
+        if default is None:
+            return self.encoder.encode(obj)
+        encoder = self.hooked_encoders.get(default)
+        if encoder is None:
+            encoder = self.hooked_encoders[default] = json.JSONEncoder(
+                default=bson_default(default))
+        return encoder.encode(obj)
+
+    def loads(self, data, object_hook=None):
+        if EXTENDED_JSON_MARKER in data:
+            return json.loads(data, object_hook=bson_object_hook(object_hook))
+        if object_hook is None:
+            return self.decoder.decode(data)
+        decoder = self.hooked_decoders.get(object_hook)
+        if decoder is None:
+            decoder = self.hooked_decoders[object_hook] = json.JSONDecoder(
+                object_hook=object_hook)
+        return decoder.decode(data)
+
+
+class PlainCodec(object):
+    """
+    Wraps a codec whose dumps / loads don't take the default and
+    object_hook keywords. The only hooks jsonrpclib passes are
+    jsonclass's, so they're replaced by a jsonclass.dump pass before
+    encoding and a jsonclass.load pass after decoding.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def dumps(self, obj, default=None):
+        if default is not None:
+            obj = jsonclass.dump(obj)
+        return self.codec.dumps(obj)
+
+    def loads(self, data, object_hook=None):
+        obj = self.codec.loads(data)
+        if object_hook is not None:
+            obj = jsonclass.load(obj)
+        return obj
+
+
+def takes_keyword(function, name):
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(function)
+    except TypeError:
+        # Builtins can't be inspected
+        return False
+    return name in args or keywords is not None
+
+
+def register_codec(name, codec):
+    if not (takes_keyword(codec.dumps, 'default') and
+            takes_keyword(codec.loads, 'object_hook')):
+        codec = PlainCodec(codec)
+    registry[name] = codec
+
+
+def get_codec(name=None):
+    if name is None:
+        name = config.codec
+    try:
+        return registry[name]
+    except KeyError:
+        raise ValueError('Unknown JSON codec %s.' % name)
+
+
+register_codec('bson', BSONCodec())
+register_codec('fast', FastCodec())
@@ -28,6 +28,9 @@ class Config(object):
     # The list of classes to use for jsonclass translation.
     version = 2.0
     # Version of the JSON-RPC spec to support
+    codec = 'fast'
+    # Name of the JSON codec used by jdumps / jloads (see
+    # jsonrpclib.codec). 'bson' always runs the bson.json_util hooks.
     user_agent = 'jsonrpclib/0.1 (Python %s)' % \
         '.'.join([str(ver) for ver in sys.version_info[0:3]])
     # User agent to use for calls.
@@ -36,117 +36,217 @@ other_types = [
 supported_types = iter_types+string_types+numeric_types+value_types
 invalid_module_chars = r'[^a-zA-Z0-9\_\.]'
 
+# Sets of the lists above, built once instead of at every level of dump,
+# and rebuilt when one of the lists grows or shrinks. Call clear_cache()
+# after replacing an entry in place.
+plain_types = set()
+supported_type_set = set()
+type_list_sizes = [None]
+
+# ClassSerializers by (class, serialize_method, ignore_attribute)
+serializers = {}
+# Classes by their dotted __jsonclass__ path
+resolved_classes = {}
+
 
 class TranslationError(Exception):
     pass
 
 
+def clear_cache():
+    """
+    Forgets the serializers and classes worked out so far, and rebuilds
+    the type sets from the lists above.
+    """
+    serializers.clear()
+    resolved_classes.clear()
+    type_list_sizes[0] = None
+    update_type_sets()
+
+
+def update_type_sets():
+    """ Rebuilds the type sets if the size of a list above changed. """
+    sizes = (len(string_types), len(numeric_types), len(value_types),
+             len(other_types), len(supported_types))
+    if sizes == type_list_sizes[0]:
+        return
+    plain_types.clear()
+    plain_types.update(numeric_types+string_types+value_types+other_types)
+    supported_type_set.clear()
+    supported_type_set.update(supported_types)
+    type_list_sizes[0] = sizes
+
+
+class ClassSerializer(object):
+    """
+    What dump needs to know about a class, worked out the first time
+    one of its instances is dumped: the __jsonclass__ name, whether it
+    has a serialize method, and the attributes it says to ignore.
+    """
+
+    def __init__(self, cls, serialize_method, ignore_attribute):
+        module_name = inspect.getmodule(cls).__name__
+        json_class = cls.__name__
+        if module_name not in ['', '__main__']:
+            json_class = '%s.%s' % (module_name, json_class)
+        self.json_class = json_class
+        self.serialize_method = serialize_method
+        self.has_serialize = serialize_method in dir(cls)
+        self.ignore_attribute = ignore_attribute
+        self.ignore = list(getattr(cls, ignore_attribute, []))
+
+    def dump(self, obj, ignore, deep=True):
+        """
+        Without deep, the attributes are left as they are, for the JSON
+        encoder to take care of.
+        """
+        attributes = getattr(obj, '__dict__', None)
+        # If a serialization method is defined..
+        if self.has_serialize or (attributes is not None and
+                                  self.serialize_method in attributes):
+            # Params can be a dict (keyword) or list (positional)
+            # Attrs MUST be a dict.
+            params, attrs = getattr(obj, self.serialize_method)()
+            return_obj = {'__jsonclass__': [self.json_class, params]}
+            return_obj.update(attrs)
+            return return_obj
+        if attributes is None:
+            # Builtin types (set, object()...) have nothing to dump
+            raise TypeError('%r is not JSON serializable.' % obj)
+        # Otherwise, try to figure it out
+        # Obviously, we can't assume to know anything about the
+        # parameters passed to __init__
+        return_obj = {'__jsonclass__': [self.json_class, []]}
+        ignore_list = attributes.get(self.ignore_attribute, self.ignore)
+        if ignore:
+            ignore_list = ignore_list + ignore
+        for attr_name, attr_value in attributes.iteritems():
+            if type(attr_value) not in supported_type_set:
+                continue
+            if ignore_list and (attr_name in ignore_list or
+                                attr_value in ignore_list):
+                continue
+            if deep:
+                attr_value = _dump(attr_value, self.serialize_method,
+                                   self.ignore_attribute, ignore)
+            return_obj[attr_name] = attr_value
+        return return_obj
+
+
+def get_serializer(cls, serialize_method, ignore_attribute):
+    key = (cls, serialize_method, ignore_attribute)
+    try:
+        return serializers[key]
+    except KeyError:
+        serializer = serializers[key] = ClassSerializer(
+            cls, serialize_method, ignore_attribute)
+        return serializer
+
+
 def dump(obj, serialize_method=None, ignore_attribute=None, ignore=[]):
     if not serialize_method:
         serialize_method = config.serialize_method
     if not ignore_attribute:
         ignore_attribute = config.ignore_attribute
+    update_type_sets()
+    return _dump(obj, serialize_method, ignore_attribute, ignore)
+
+
+def default(obj):
+    """
+    Dumps a single instance, for use as the default hook of a JSON
+    encoder -- which calls it for each object it can't serialize, and
+    encodes what it returns in turn, so nothing else has to be copied.
+    The types dump leaves alone (ObjectId, datetime...) are refused with
+    a TypeError, for the codec to handle.
+    """
+    update_type_sets()
+    if type(obj) in plain_types:
+        raise TypeError('%r is not a class instance.' % obj)
+    return get_serializer(
+        obj.__class__, config.serialize_method,
+        config.ignore_attribute).dump(obj, [], deep=False)
+
+
+def _dump(obj, serialize_method, ignore_attribute, ignore):
     obj_type = type(obj)
     # Parse / return default "types"...
-    if obj_type in numeric_types+string_types+value_types + other_types:
+    if obj_type in plain_types:
         return obj
-    if obj_type in iter_types:
-        if obj_type in (types.ListType, types.TupleType):
-            new_obj = []
-            for item in obj:
-                new_obj.append(
-                    dump(item, serialize_method, ignore_attribute, ignore))
-            if isinstance(obj_type, types.TupleType):
-                new_obj = tuple(new_obj)
-            return new_obj
-        # It's a dict...
-        else:
-            new_obj = {}
-            for key, value in obj.iteritems():
-                new_obj[key] = dump(
-                    value, serialize_method, ignore_attribute, ignore)
-            return new_obj
-    # It's not a standard type, so it needs __jsonclass__
-    module_name = inspect.getmodule(obj).__name__
-    class_name = obj.__class__.__name__
-    json_class = class_name
-    if module_name not in ['', '__main__']:
-        json_class = '%s.%s' % (module_name, json_class)
-    return_obj = {"__jsonclass__": [json_class]}
-    # If a serialization method is defined..
-    if serialize_method in dir(obj):
-        # Params can be a dict (keyword) or list (positional)
-        # Attrs MUST be a dict.
-        serialize = getattr(obj, serialize_method)
-        params, attrs = serialize()
-        return_obj['__jsonclass__'].append(params)
-        return_obj.update(attrs)
-        return return_obj
-    # Otherwise, try to figure it out
-    # Obviously, we can't assume to know anything about the
-    # parameters passed to __init__
-    return_obj['__jsonclass__'].append([])
-    attrs = {}
-    ignore_list = getattr(obj, ignore_attribute, [])+ignore
-    for attr_name, attr_value in obj.__dict__.iteritems():
-        if type(attr_value) in supported_types and \
-                attr_name not in ignore_list and \
-                attr_value not in ignore_list:
-            attrs[attr_name] = dump(
-                attr_value, serialize_method, ignore_attribute, ignore)
-    return_obj.update(attrs)
-    return return_obj
+    if obj_type is types.ListType or obj_type is types.TupleType:
+        return [_dump(item, serialize_method, ignore_attribute, ignore)
+                for item in obj]
+    if obj_type is types.DictType:
+        new_obj = {}
+        for key, value in obj.iteritems():
+            new_obj[key] = _dump(
+                value, serialize_method, ignore_attribute, ignore)
+        return new_obj
+    # It's not a standard type, so it needs __jsonclass__ (and old-style
+    # instances are all of the same type)
+    return get_serializer(
+        obj.__class__, serialize_method, ignore_attribute).dump(obj, ignore)
 
 
 def load(obj):
-    if type(obj) in string_types + numeric_types + value_types + other_types:
-        return obj
+    """
+    Translates the __jsonclass__ dicts in obj back into instances.
+    Lists and dicts are only copied if something in them was
+    translated, otherwise they're returned as they are.
+    """
+    update_type_sets()
+    return _load(obj)
+
 
-    if isinstance(obj, list):
-        return_list = []
-        for entry in obj:
-            return_list.append(load(entry))
-        return return_list
-    # Othewise, it's a dict type
+def _load(obj):
+    obj_type = type(obj)
+    if obj_type in plain_types:
+        return obj
+    if obj_type is types.ListType or isinstance(obj, list):
+        new_list = None
+        for i, entry in enumerate(obj):
+            if type(entry) in plain_types:
+                continue
+            new_entry = _load(entry)
+            if new_entry is not entry:
+                if new_list is None:
+                    new_list = list(obj)
+                new_list[i] = new_entry
+        if new_list is None:
+            return obj
+        return new_list
+    if not isinstance(obj, dict):
+        return obj
     if '__jsonclass__' not in obj:
-        return_dict = {}
+        new_dict = None
         for key, value in obj.iteritems():
-            new_value = load(value)
-            return_dict[key] = new_value
-        return return_dict
-    # It's a dict, and it's a __jsonclass__
-    orig_module_name = obj['__jsonclass__'][0]
+            if type(value) in plain_types:
+                continue
+            new_value = _load(value)
+            if new_value is not value:
+                if new_dict is None:
+                    new_dict = dict(obj)
+                new_dict[key] = new_value
+        if new_dict is None:
+            return obj
+        return new_dict
+    return load_instance(obj)
+
+
+def object_hook(obj):
+    """
+    Translates a single __jsonclass__ dict, for use as the object_hook
+    of a JSON decoder -- which calls it on the innermost dicts first,
+    so the whole document is translated as it's decoded.
+    """
+    if '__jsonclass__' not in obj:
+        return obj
+    return load_instance(obj)
+
+
+def load_instance(obj):
+    json_class = get_class(obj['__jsonclass__'][0])
     params = obj['__jsonclass__'][1]
-    if orig_module_name == '':
-        raise TranslationError('Module name empty.')
-    json_module_clean = re.sub(invalid_module_chars, '', orig_module_name)
-    if json_module_clean != orig_module_name:
-        raise TranslationError('Module name %s has invalid characters.' %
-                               orig_module_name)
-    json_module_parts = json_module_clean.split('.')
-    json_class = None
-    if len(json_module_parts) == 1:
-        # Local class name -- probably means it won't work
-        if json_module_parts[0] not in config.classes.keys():
-            raise TranslationError('Unknown class or module %s.' %
-                                   json_module_parts[0])
-        json_class = config.classes[json_module_parts[0]]
-    else:
-        json_class_name = json_module_parts.pop()
-        json_module_tree = '.'.join(json_module_parts)
-        try:
-            temp_module = __import__(json_module_tree)
-        except ImportError:
-            raise TranslationError('Could not import %s from module %s.' %
-                                   (json_class_name, json_module_tree))
-
-        # The returned class is the top-level module, not the one we really
-        # want.  (E.g., if we import a.b.c, we now have a.)  Walk through other
-        # path components to get to b and c.
-        for i in json_module_parts[1:]:
-            temp_module = getattr(temp_module, i)
-
-        json_class = getattr(temp_module, json_class_name)
     # Creating the object...
     new_obj = None
     if isinstance(params, list):
@@ -160,3 +260,47 @@ def load(obj):
             continue
         setattr(new_obj, key, value)
     return new_obj
+
+
+def get_class(orig_module_name):
+    """
+    Finds the class a __jsonclass__ path refers to. Dotted paths are
+    imported once and then cached; bare class names are looked up in
+    config.classes every time, since it can change.
+    """
+    json_class = resolved_classes.get(orig_module_name) or \
+        config.classes.get(orig_module_name)
+    if json_class is not None:
+        return json_class
+    if orig_module_name == '':
+        raise TranslationError('Module name empty.')
+    json_module_clean = re.sub(invalid_module_chars, '', orig_module_name)
+    if json_module_clean != orig_module_name:
+        raise TranslationError('Module name %s has invalid characters.' %
+                               orig_module_name)
+    json_module_parts = json_module_clean.split('.')
+    if len(json_module_parts) == 1:
+        # Local class name -- probably means it won't work
+        if json_module_parts[0] not in config.classes.keys():
+            raise TranslationError('Unknown class or module %s.' %
+                                   json_module_parts[0])
+        return config.classes[json_module_parts[0]]
+    json_class_name = json_module_parts.pop()
+    json_module_tree = '.'.join(json_module_parts)
+    try:
+        temp_module = __import__(json_module_tree)
+    except ImportError:
+        raise TranslationError('Could not import %s from module %s.' %
+                               (json_class_name, json_module_tree))
+
+    # The returned class is the top-level module, not the one we really
+    # want.  (E.g., if we import a.b.c, we now have a.)  Walk through other
+    # path components to get to b and c.
+    for i in json_module_parts[1:]:
+        temp_module = getattr(temp_module, i)
+
+    json_class = getattr(temp_module, json_class_name)
+    resolved_classes[orig_module_name] = json_class
+    return json_class
+
+clear_cache()
@@ -47,25 +47,32 @@ See http://code.google.com/p/jsonrpclib/ for more info.
 """
 
 import types
+import httplib
 from xmlrpclib import Transport as XMLTransport
 from xmlrpclib import SafeTransport as XMLSafeTransport
 from xmlrpclib import ServerProxy as XMLServerProxy
 from xmlrpclib import _Method as XML_Method
 import string
 import random
+import threading
+import time
 import exceptions
+import sys
+import itertools
+from json.encoder import encode_basestring_ascii
 
 # Library includes
 from jsonrpclib import config
 from jsonrpclib import history
+from jsonrpclib import jsonclass
 from jsonrpclib.custom_exceptions import custom_exceptions
-from bson import json_util
-
-# JSON library importing
-cjson = None
-json = None
+from jsonrpclib.codec import get_codec
+from jsonrpclib.stream import BatchSplitter
+from jsonrpclib.workers import Future, WorkerPool
 
 IDCHARS = string.ascii_lowercase+string.digits
+# Without this in the text, there's nothing for jsonclass.load to do
+JSONCLASS_MARKER = '"__jsonclass__"'
 
 
 class UnixSocketMissing(Exception):
@@ -79,12 +86,16 @@ class UnixSocketMissing(Exception):
 # JSON Abstractions
 
 
-def jdumps(obj, encoding='utf-8'):
-    return json_util.dumps(obj)
+def jdumps(obj, encoding='utf-8', default=None):
+    if default is None:
+        return get_codec().dumps(obj)
+    return get_codec().dumps(obj, default=default)
 
 
-def jloads(json_string):
-    return json_util.loads(json_string)
+def jloads(json_string, object_hook=None):
+    if object_hook is None:
+        return get_codec().loads(json_string)
+    return get_codec().loads(json_string, object_hook=object_hook)
 
 
 # XMLRPClib re-implementations
@@ -95,24 +106,142 @@ class ProtocolError(Exception):
 
 
 class TransportMixIn(object):
-    """ Just extends the XMLRPC transport where necessary. """
+    """
+    Just extends the XMLRPC transport where necessary, and keeps one
+    persistent (HTTP/1.1 keep-alive) connection per host instead of
+    xmlrpclib's single most recently used one.
+    """
     user_agent = config.user_agent
     # for Python 2.7 support
     _connection = (None, None)
     _extra_headers = []
+    keep_alive_timeout = 10
+    # Seconds an idle connection is reused for -- keep it below the
+    # server's own idle timeout to avoid racing it.
+    _streaming = False
+    _pending = None
+
+    def __init__(self):
+        self._connections = {}
+
+    def make_connection(self, host):
+        if self._pending is not None:
+            # The last response has to be read before the next request
+            self._pending.drain()
+        now = time.time()
+        entry = self._connections.get(host)
+        if entry is not None:
+            connection, extra_headers, last_used = entry
+            if now - last_used < self.keep_alive_timeout:
+                entry[2] = now
+                self._extra_headers = extra_headers
+                return connection
+            connection.close()
+        # Make sure the base class opens a new one
+        self._connection = (None, None)
+        connection = self._open_connection(host)
+        self._connections[host] = [connection, self._extra_headers, now]
+        return connection
+
+    def _open_connection(self, host):
+        return super(TransportMixIn, self).make_connection(host)
+
+    def close(self):
+        for connection, extra_headers, last_used in \
+                self._connections.values():
+            connection.close()
+        self._connections.clear()
+        self._connection = (None, None)
 
     def send_content(self, connection, request_body):
         connection.putheader("Content-Type", "application/json-rpc")
         connection.putheader("Content-Length", str(len(request_body)))
-        connection.endheaders()
-        if request_body:
-            connection.send(request_body)
+        # Headers and body go out in one packet, otherwise Nagle's
+        # algorithm stalls every request on a kept-alive connection.
+        connection.endheaders(request_body)
+
+    def request_stream(self, host, handler, request_body, verbose=0):
+        """
+        Like request, but a chunked response comes back as a
+        ResponseStream, which reads the body as it's iterated over.
+        """
+        self._streaming = True
+        try:
+            return self.request(host, handler, request_body, verbose)
+        finally:
+            self._streaming = False
+
+    def parse_response(self, response):
+        if self._streaming and getattr(response, 'chunked', False) and \
+                response.getheader('Content-Encoding', '') != 'gzip':
+            self._pending = ResponseStream(self, response)
+            return self._pending
+        return super(TransportMixIn, self).parse_response(response)
 
     def getparser(self):
         target = JSONTarget()
         return JSONParser(target), target
 
 
+class ResponseStream(object):
+    """
+    Iterates over the chunks of a chunked response as they arrive. If
+    another request is sent on the transport before it's all been read,
+    the rest is read (and kept) first.
+    """
+
+    def __init__(self, transport, response):
+        self.transport = transport
+        self.response = response
+        self.buffered = []
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.buffered:
+            return self.buffered.pop(0)
+        if self.response is None:
+            raise StopIteration
+        try:
+            data = self._read_chunk()
+        except:
+            # The connection is in an unknown state
+            self.response = None
+            self.transport._pending = None
+            self.transport.close()
+            raise
+        if not data:
+            self.response.close()
+            self.response = None
+            self.transport._pending = None
+            raise StopIteration
+        return data
+
+    def _read_chunk(self):
+        # HTTPResponse.read(amt) waits until it has amt bytes, so the
+        # chunks are read one by one here instead.
+        fp = self.response.fp
+        line = fp.readline()
+        try:
+            size = int(line.split(';', 1)[0], 16)
+        except ValueError:
+            raise httplib.IncompleteRead('')
+        if not size:
+            # Skip the trailer
+            while line and line != '\r\n':
+                line = fp.readline()
+            return ''
+        data = fp.read(size)
+        if len(data) < size:
+            raise httplib.IncompleteRead(data, size - len(data))
+        fp.read(2)
+        return data
+
+    def drain(self):
+        self.buffered = [''.join(list(self))]
+
+
 class JSONParser(object):
     def __init__(self, target):
         self.target = target
@@ -146,7 +275,7 @@ class SafeTransport(TransportMixIn, XMLSafeTransport):
         TransportMixIn.__init__(self)
         XMLSafeTransport.__init__(self)
 
-from httplib import HTTP, HTTPConnection
+from httplib import HTTPConnection
 from socket import socket
 
 USE_UNIX_SOCKETS = False
@@ -164,14 +293,14 @@ if (USE_UNIX_SOCKETS):
             self.sock = socket(AF_UNIX, SOCK_STREAM)
             self.sock.connect(self.host)
 
-    class UnixHTTP(HTTP):
-        _connection_class = UnixHTTPConnection
-
     class UnixTransport(TransportMixIn, XMLTransport):
+        def __init__(self):
+            TransportMixIn.__init__(self)
+            XMLTransport.__init__(self)
 
-        def make_connection(self, host):
-            host, extra_headers, x509 = self.get_host_info(host)
-            return UnixHTTP(host)
+        def _open_connection(self, host):
+            host, self._extra_headers, x509 = self.get_host_info(host)
+            return UnixHTTPConnection(host)
 
 
 class ServerProxy(XMLServerProxy):
@@ -181,7 +310,7 @@ class ServerProxy(XMLServerProxy):
     """
 
     def __init__(self, uri, transport=None, encoding=None,
-                 verbose=0, version=None):
+                 verbose=0, version=None, cache=None):
         import urllib
         if not version:
             version = config.version
@@ -211,8 +340,16 @@ class ServerProxy(XMLServerProxy):
         self.__transport = transport
         self.__encoding = encoding
         self.__verbose = verbose
+        self.__cache = cache
 
     def _request(self, methodname, params, rpcid=None):
+        if self.__cache is not None:
+            return self.__cache.call(
+                methodname, params,
+                lambda: self._send_request(methodname, params, rpcid))
+        return self._send_request(methodname, params, rpcid)
+
+    def _send_request(self, methodname, params, rpcid=None):
         request = dumps(params, methodname, encoding=self.__encoding,
                         rpcid=rpcid, version=self.__version)
         response = self._run_request(request)
@@ -248,6 +385,27 @@ class ServerProxy(XMLServerProxy):
         return_obj = loads(response)
         return return_obj
 
+    def _run_batch_request(self, request):
+        """
+        Like _run_request for a batch, but returns an iterator over the
+        text of each entry of the response, for MultiCallIterator to
+        decode when it's needed. If the server streams the response,
+        the entries come as they arrive.
+        """
+        if not hasattr(self.__transport, 'request_stream'):
+            return self._run_request(request) or []
+        history.add_request(request)
+        response = self.__transport.request_stream(
+            self.__host,
+            self.__handler,
+            request,
+            verbose=self.__verbose
+        )
+        if not isinstance(response, types.StringTypes):
+            return iter_batch(response)
+        history.add_response(response)
+        return iter_batch([response], record=False)
+
     def __getattr__(self, name):
         # Same as original, just with new _Method reference
         return _Method(self._request, name)
@@ -335,21 +493,58 @@ class MultiCallNotify(object):
 
 
 class MultiCallIterator(object):
+    """
+    The results of a batch. They can be given decoded, or as the text
+    of each entry, which is only decoded (and class translated) when
+    that result is used. Either can come from an iterator, such as a
+    response still coming in, which is only read as far as needed.
+    """
 
     def __init__(self, results):
-        self.results = results
+        self.results = []
+        self._undecoded = {}
+        self._remaining = iter(results)
+
+    def _fetch(self, count=None):
+        while self._remaining is not None and \
+                (count is None or len(self.results) < count):
+            try:
+                item = self._remaining.next()
+            except StopIteration:
+                self._remaining = None
+                break
+            if isinstance(item, types.StringTypes):
+                self._undecoded[len(self.results)] = item
+                item = None
+            self.results.append(item)
+
+    def _decoded(self, i):
+        if i < 0:
+            i += len(self.results)
+        if i in self._undecoded:
+            self.results[i] = loads(self._undecoded.pop(i))
+        return self.results[i]
 
     def __iter__(self):
-        for i in range(0, len(self.results)):
+        i = 0
+        while True:
+            self._fetch(i + 1)
+            if i >= len(self.results):
+                return
             yield self[i]
-        raise StopIteration
+            i += 1
 
     def __getitem__(self, i):
-        item = self.results[i]
+        if i < 0:
+            self._fetch()
+        else:
+            self._fetch(i + 1)
+        item = self._decoded(i)
         check_for_errors(item)
         return item['result']
 
     def __len__(self):
+        self._fetch()
         return len(self.results)
 
 
@@ -365,7 +560,7 @@ class MultiCall(object):
             return
         request_body = '[ {0} ]'.format(
             ','.join([job.request() for job in self._job_list]))
-        responses = self._server._run_request(request_body)
+        responses = self._server._run_batch_request(request_body)
         del self._job_list[:]
         if not responses:
             responses = []
@@ -387,6 +582,211 @@ class MultiCall(object):
 Server = ServerProxy
 
 
+# Concurrent calls
+
+
+class AsyncServerProxy(object):
+    """
+    Same call syntax as ServerProxy, but every call returns a
+    jsonrpclib.workers.Future right away. Up to max_connections calls
+    are in flight at once, each on its own persistent connection, so
+    fanning out to many calls costs about one round trip:
+
+    >>> proxy = jsonrpclib.AsyncServerProxy('http://localhost:8080',
+    ...                                     max_connections=100)
+    >>> futures = [proxy.add(i, 1) for i in range(100)]
+    >>> [future.result() for future in futures]
+
+    Since transports aren't thread safe, a custom one is given as a
+    factory, called once per connection. A cache (ResponseCache) is
+    shared by all of them.
+    """
+
+    def __init__(self, uri, transport_factory=None, encoding=None,
+                 verbose=0, version=None, max_connections=20, cache=None):
+        self.__uri = uri
+        self.__transport_factory = transport_factory
+        self.__encoding = encoding
+        self.__verbose = verbose
+        self.__version = version
+        self.__cache = cache
+        self.__local = threading.local()
+        # The transports of every thread, for close
+        self.__transports = []
+        self.__lock = threading.Lock()
+        self.__pool = WorkerPool(max_connections, name='AsyncServerProxy')
+        # Fail early on a bad uri
+        self.__server()
+
+    def __server(self):
+        server = getattr(self.__local, 'server', None)
+        if server is None:
+            transport = None
+            if self.__transport_factory is not None:
+                transport = self.__transport_factory()
+            server = ServerProxy(
+                self.__uri, transport=transport, encoding=self.__encoding,
+                verbose=self.__verbose, version=self.__version,
+                cache=self.__cache)
+            self.__local.server = server
+            with self.__lock:
+                self.__transports.append(server._ServerProxy__transport)
+        return server
+
+    def __call(self, notify, methodname, params):
+        server = self.__server()
+        if notify:
+            return server._request_notify(methodname, params)
+        return server._request(methodname, params)
+
+    def _request(self, methodname, params):
+        return self.__pool.submit(self.__call, False, methodname, params)
+
+    def _request_notify(self, methodname, params):
+        return self.__pool.submit(self.__call, True, methodname, params)
+
+    def close(self):
+        """ Waits for the calls in flight, and closes the connections. """
+        self.__pool.shutdown()
+        with self.__lock:
+            transports, self.__transports = self.__transports, []
+        for transport in transports:
+            if hasattr(transport, 'close'):
+                transport.close()
+
+    def __getattr__(self, name):
+        return _Method(self._request, name)
+
+    @property
+    def _notify(self):
+        return _Notify(self._request_notify)
+
+
+class PendingBatch(object):
+    """ Calls waiting to go out together, and their Futures by id. """
+
+    def __init__(self):
+        self.requests = []
+        self.futures = {}
+        self.full = threading.Event()
+
+
+class BatchingServerProxy(object):
+    """
+    Same call syntax (and blocking calls) as ServerProxy, but calls
+    made from different threads at about the same time are sent as one
+    batch, and each gets its own response back by id. A batch goes out
+    once it has max_batch calls, or window seconds after its first one
+    (which is the thread that sends it):
+
+    >>> proxy = jsonrpclib.BatchingServerProxy('http://localhost:8080',
+    ...                                        max_batch=50, window=0.005)
+    >>> proxy.add(5, 6)  # from any number of threads
+    11
+
+    Batches are a 2.0 feature, so the calls are always 2.0 requests. As
+    with AsyncServerProxy, a custom transport is given as a factory,
+    called once per sending thread.
+    """
+
+    def __init__(self, uri, transport_factory=None, encoding=None,
+                 verbose=0, max_batch=20, window=0.005):
+        self.__uri = uri
+        self.__transport_factory = transport_factory
+        self.__encoding = encoding
+        self.__verbose = verbose
+        self.__max_batch = max_batch
+        self.__window = window
+        self.__ids = itertools.count(1)
+        self.__batch = None
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        # Fail early on a bad uri
+        self.__server()
+
+    def __server(self):
+        server = getattr(self.__local, 'server', None)
+        if server is None:
+            transport = None
+            if self.__transport_factory is not None:
+                transport = self.__transport_factory()
+            server = ServerProxy(
+                self.__uri, transport=transport, encoding=self.__encoding,
+                verbose=self.__verbose, version=2.0)
+            self.__local.server = server
+        return server
+
+    def __submit(self, request, rpcid=None):
+        """
+        Adds the request to the pending batch, sending it if this
+        thread started it, and returns the Future of its response.
+        """
+        future = None
+        with self.__lock:
+            batch = self.__batch
+            if batch is None:
+                batch = self.__batch = PendingBatch()
+                leader = True
+            else:
+                leader = False
+            batch.requests.append(request)
+            if rpcid is not None:
+                future = batch.futures[rpcid] = Future()
+            if len(batch.requests) >= self.__max_batch:
+                self.__batch = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.__window)
+            with self.__lock:
+                if self.__batch is batch:
+                    self.__batch = None
+            self.__send(batch)
+        return future
+
+    def __send(self, batch):
+        try:
+            responses = self.__server()._run_request(
+                '[%s]' % ','.join(batch.requests))
+            if isinstance(responses, dict):
+                # Most likely an error about the whole batch
+                check_for_errors(responses)
+                raise ProtocolError('Batch response expected.')
+        except:
+            exc_info = sys.exc_info()
+            for future in batch.futures.itervalues():
+                future.set_exception(exc_info)
+            return
+        for response in responses or []:
+            future = batch.futures.pop(response.get('id'), None)
+            if future is not None:
+                future.set_result(response)
+        for future in batch.futures.itervalues():
+            try:
+                raise ProtocolError('No response for this call in batch.')
+            except ProtocolError:
+                future.set_exception()
+
+    def _request(self, methodname, params):
+        rpcid = self.__ids.next()
+        request = dumps(params, methodname, encoding=self.__encoding,
+                        rpcid=rpcid, version=2.0)
+        response = self.__submit(request, rpcid).result()
+        check_for_errors(response)
+        return response['result']
+
+    def _request_notify(self, methodname, params):
+        request = dumps(params, methodname, encoding=self.__encoding,
+                        version=2.0, notify=True)
+        self.__submit(request)
+
+    def __getattr__(self, name):
+        return _Method(self._request, name)
+
+    @property
+    def _notify(self):
+        return _Notify(self._request_notify)
+
+
 class Fault(object):
     # JSON-RPC error class
 
@@ -411,6 +811,27 @@ class Fault(object):
         return '<Fault %s: %s>' % (self.faultCode, self.faultString)
 
 
+class RawJSON(object):
+    """
+    JSON text to be sent as it is, such as a result that's already
+    serialized. Return one from a method (or pass it to dumps as the
+    params of a methodresponse) and it's spliced into the response,
+    without being decoded and encoded again. Unicode text is encoded
+    to UTF-8, like the rest of the response.
+    """
+
+    def __init__(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return '<RawJSON %s>' % self.text
+
+
 def random_id(length=8):
     return_id = ''
     for i in range(length):
@@ -463,6 +884,64 @@ class Payload(dict):
         return error
 
 
+class Envelopes(object):
+    """
+    The fixed parts of the requests and responses of one version of the
+    spec, worked out once, with a %s for each of the method, params,
+    result, error and id -- so that only those need encoding.
+    """
+
+    def __init__(self, version):
+        version = float(version)
+        if version >= 2:
+            head = '{"jsonrpc": %s, ' % encode_basestring_ascii(str(version))
+            self.request = head + '"method": %s, "params": %s, "id": %s}'
+            self.request_no_params = head + '"method": %s, "id": %s}'
+            self.notify = head + '"method": %s, "params": %s}'
+            self.notify_no_params = head + '"method": %s}'
+            self.response = head + '"result": %s, "id": %s}'
+            self.error = head + '"error": %s, "id": %s}'
+        else:
+            self.request = '{"method": %s, "params": %s, "id": %s}'
+            self.request_no_params = '{"method": %s, "id": %s}'
+            self.notify = '{"method": %s, "params": %s, "id": null}'
+            self.notify_no_params = '{"method": %s, "id": null}'
+            self.response = '{"result": %s, "error": null, "id": %s}'
+            self.error = '{"result": null, "error": %s, "id": %s}'
+
+
+# Envelopes by version
+envelopes = {}
+
+
+def get_envelopes(version):
+    try:
+        return envelopes[version]
+    except KeyError:
+        envelope = envelopes[version] = Envelopes(version)
+        return envelope
+
+
+def encode_id(rpcid):
+    if rpcid is None:
+        return 'null'
+    if type(rpcid) in types.StringTypes:
+        return encode_basestring_ascii(rpcid)
+    return jdumps(rpcid)
+
+
+def encode_result(result, encoding=None):
+    """
+    The JSON of a result, as it goes in a response (RawJSON as it is).
+    """
+    if isinstance(result, RawJSON):
+        return result.text
+    default = None
+    if config.use_jsonclass is True:
+        default = jsonclass.default
+    return jdumps(result, encoding=encoding or 'utf-8', default=default)
+
+
 def dumps(
         params=[], methodname=None, methodresponse=None,
         encoding=None, rpcid=None, version=None, notify=None):
@@ -482,13 +961,15 @@ def dumps(
         """
         raise TypeError('Params must be a dict, list, tuple or Fault ' +
                         'instance.')
-    # Begin parsing object
-    payload = Payload(rpcid=rpcid, version=version)
+    # Only the params / result, error and id are encoded, and put in
+    # the envelope for the version
+    envelope = get_envelopes(version)
     if not encoding:
         encoding = 'utf-8'
     if type(params) is Fault:
-        response = payload.error(params.faultCode, params.faultString)
-        return jdumps(response, encoding=encoding)
+        return envelope.error % (
+            jdumps(params.error(), encoding=encoding), encode_id(rpcid))
+    default = None
 
     if type(methodname) not in types.StringTypes and \
             methodresponse is not True:
@@ -497,19 +978,27 @@ def dumps(
             'be set to True.')
 
     if config.use_jsonclass is True:
-        from jsonrpclib import jsonclass
-        params = jsonclass.dump(params)
+        # Class instances are translated as the encoder comes across
+        # them, without copying everything else
+        default = jsonclass.default
     if methodresponse is True:
         if rpcid is None:
             raise ValueError('A method response must have an rpcid.')
-        response = payload.response(params)
-        return jdumps(response, encoding=encoding)
-    request = None
+        return envelope.response % (
+            encode_result(params, encoding), encode_id(rpcid))
+    method = encode_basestring_ascii(methodname)
     if notify is True:
-        request = payload.notify(methodname, params)
-    else:
-        request = payload.request(methodname, params)
-    return jdumps(request, encoding=encoding)
+        if params:
+            return envelope.notify % (
+                method, jdumps(params, encoding=encoding, default=default))
+        return envelope.notify_no_params % method
+    if not rpcid:
+        rpcid = random_id()
+    if params:
+        return envelope.request % (
+            method, jdumps(params, encoding=encoding, default=default),
+            encode_id(rpcid))
+    return envelope.request_no_params % (method, encode_id(rpcid))
 
 
 def loads(data):
@@ -521,14 +1010,13 @@ def loads(data):
     if data == '':
         # notification
         return None
-    result = jloads(data)
-    # if the above raises an error, the implementing server code
+    # if the below raises an error, the implementing server code
     # should return something like the following:
     # { 'jsonrpc':'2.0', 'error': fault.error(), id: None }
-    if config.use_jsonclass is True:
-        from jsonrpclib import jsonclass
-        result = jsonclass.load(result)
-    return result
+    if config.use_jsonclass is True and JSONCLASS_MARKER in data:
+        # Classes are translated as the decoder builds each dict
+        return jloads(data, object_hook=jsonclass.object_hook)
+    return jloads(data)
 
 
 def check_for_errors(result):
@@ -578,6 +1066,33 @@ def check_for_errors(result):
     return result
 
 
+def iter_batch(chunks, record=True):
+    """
+    Splits a batch response given in chunks into the (undecoded) text
+    of its entries, each as soon as it's complete. With record, the
+    response is added to the history once it's all been read.
+    """
+    splitter = BatchSplitter()
+    elements = []
+    for chunk in chunks:
+        for element in splitter.feed(chunk):
+            elements.append(element)
+            yield element
+    if splitter.is_array is False:
+        # A single error for the whole batch
+        response = splitter.document
+        if record:
+            history.add_response(response)
+        check_for_errors(loads(response))
+        raise ProtocolError('Batch response is not a list.')
+    for element in splitter.close():
+        elements.append(element)
+        yield element
+    if record:
+        history.add_response(
+            splitter.is_array and '[%s]' % ','.join(elements) or '')
+
+
 def isbatch(result):
     if type(result) not in (types.ListType, types.TupleType):
         return False
@@ -1,46 +1,110 @@
-import datetime
+import errno
+import heapq
 import logging
 import inspect
+import math
+import random
 import socket
-from collections import defaultdict
-from itertools import cycle
+import sys
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+from itertools import count
 from copy import deepcopy
 
 from jsonrpclib import Server
-from jsonrpclib.jsonrpc import Transport
+from jsonrpclib.jsonrpc import Transport, _Method
+from jsonrpclib.workers import WorkerPool
 
 
 logger = logging.getLogger('jsonrpclib')
 
 
 class ConnectionPool(object):
-    def __init__(self, servers_dict=None, transport_method='django', user=None, reinitiate_delay=5):
+    """
+    Hands out connections to the servers of each name, skipping the
+    ones that are down, and picking among the others with the balancer
+    (a name from balancers, or a class). Whether they're up is checked
+    every check_interval seconds by a background thread (a TCP
+    connect, given check_timeout seconds), so looking one up only reads
+    a flag.
+
+    A server is given as (host, port[, auth_user, auth_password[,
+    weight]]); the weight is used by the weighted_round_robin balancer.
+
+    Servers whose requests keep failing are also left out for a while
+    by their circuit breaker (an instance of the breaker class).
+
+    Calls to the hedge_methods (idempotent ones only) are hedged: see
+    HedgingProxy.
+
+    reinitiate_delay is only accepted for compatibility: dead servers
+    are rechecked every check_interval seconds instead.
+    """
+
+    def __init__(self, servers_dict=None, transport_method='django', user=None, reinitiate_delay=None,
+                 check_interval=5, check_timeout=1, max_idle=4, balancer='round_robin', breaker=None,
+                 hedge_methods=(), hedge_percentile=95, hedge_budget=0.1, hedge_workers=32):
         if servers_dict is None:
             raise ValueError('Server list shouldn\'t be empty')
 
-        self.reinitiate_delay = datetime.timedelta(seconds=reinitiate_delay)
-
         self.original = deepcopy(servers_dict)
         self.user = user
         self.transport_method = transport_method
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.max_idle = max_idle
+        self.balancer = balancer
+        self.breaker = breaker or CircuitBreaker
+        self.hedge_methods = set(hedge_methods)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_workers = hedge_workers
+        self.hedgers = {}
+        self.hedge_pool = None
+        self.hedge_lock = threading.Lock()
+        self.connections = {}
 
         self._create_server_list()
 
+        self.checker = None
+        if check_interval:
+            self.checker = HealthChecker(self, check_interval)
+            self.checker.start()
+
     def _create_server_list(self):
-        self.initiate_time = datetime.datetime.now()
         self.black_list = defaultdict(list)
-        self.servers = {}
+        # Connections (and their idle sockets) are kept when they're still listed
+        existing = dict(
+            ((server_name, connection.connection_info), connection)
+            for server_name, connections in self.connections.items()
+            for connection in connections
+        )
+        self.connections = {}
+        self.balancers = {}
 
         for server_name, connections in self.original.items():
             servers = []
             for connection in connections:
-                servers.append(Connection(self.transport_method, self.user, *connection))
-
-            self.servers[server_name] = cycle(servers)
+                connection_info = tuple(connection[:4]) + (None,) * (4 - len(connection))
+                server = existing.pop((server_name, connection_info), None)
+                if server is None:
+                    server = Connection(self.transport_method, self.user, *connection, max_idle=self.max_idle,
+                                        breaker=self.breaker())
+                elif len(connection) > 4:
+                    server.weight = connection[4]
+                servers.append(server)
+
+            self.connections[server_name] = servers
+            self.balancers[server_name] = get_balancer(self.balancer)()
 
     def __getattr__(self, name):
         """ needed for transport """
         if name in self.original:
+            if self.hedge_methods:
+                return self.get_hedging_proxy(name)
+
             return self.get_available_server(name).connection
         else:
             raise InvalidServerName('Specified server name doesn\'t exists')
@@ -49,40 +113,57 @@ class ConnectionPool(object):
         return self.original.keys()
 
     def get_available_server(self, server_name):
-        connection = self._get_server(server_name)
+        connections = [
+            connection for connection in self.connections[server_name]
+            if self.is_alive(server_name, connection) and connection.breaker.available()
+        ]
+        balancer = self.balancers[server_name]
+        while connections:
+            connection = balancer.choose(connections)
+            # A recovering server may have just been given its probe
+            if connection.breaker.allow():
+                return connection
 
-        is_alive = self.is_alive(server_name, connection)
-        while connection in self.black_list[server_name] or (not is_alive):
-            connection = self._get_server(server_name)
-            is_alive = self.is_alive(server_name, connection)
+            connections.remove(connection)
 
-        return connection
-
-    def _get_server(self, server_name):
-        try:
-            return self.servers[server_name].next()
-        except StopIteration:
-            now = datetime.datetime.now()
-            if self.initiate_time < (now - self.reinitiate_delay):
-                self._create_server_list()
-
-            raise NoServer('All servers are offline')
+        raise NoServer('All servers are offline')
 
     def is_alive(self, server_name, connection):
-        alive = connection.is_alive
-
-        if not alive:
-            self.black_list[server_name].append(connection)
-            new_server_list = deepcopy(self.original[server_name])
-            new_server_list.remove(connection.connection_info)
-
-            servers = []
-            for connection in new_server_list:
-                servers.append(Connection(self.transport_method, self.user, *connection))
-
-            self.servers[server_name] = cycle(servers)
-
-        return alive
+        return connection.is_alive
+
+    def check_servers(self):
+        """ Checks every server once, and lists the dead ones in black_list. """
+        for server_name, connections in self.connections.items():
+            self.black_list[server_name] = [
+                connection for connection in connections
+                if not connection.check(self.check_timeout)
+            ]
+
+    def get_hedging_proxy(self, server_name):
+        with self.hedge_lock:
+            if self.hedge_pool is None:
+                self.hedge_pool = WorkerPool(self.hedge_workers, name='jsonrpclib-hedge')
+                self.scheduler = Scheduler()
+                self.scheduler.start()
+
+            if server_name not in self.hedgers:
+                self.hedgers[server_name] = HedgingProxy(
+                    self, server_name, self.hedge_methods, self.hedge_percentile, self.hedge_budget
+                )
+
+            return self.hedgers[server_name]
+
+    def close(self):
+        if self.checker is not None:
+            self.checker.stop()
+
+        if self.hedge_pool is not None:
+            self.scheduler.stop()
+            self.hedge_pool.shutdown(wait=False)
+
+        for connections in self.connections.values():
+            for connection in connections:
+                connection.close()
 
     def add_server(self, name, connection_info):
         if name in self.original:
@@ -94,37 +175,129 @@ class ConnectionPool(object):
 
 
 class Connection(object):
-    def __init__(self, transport_method, user, host, port, auth_user=None, auth_password=None):
+    """
+    One server of a pool. Its ServerProxy is made once and shared by
+    all threads, with up to max_idle kept-alive transports waiting to
+    be reused between requests.
+    """
+
+    decay = 10.0
+    # Seconds over which the latency EWMA forgets a slow response
+    initial_latency = 0.001
+    # Latency assumed until the first response
+
+    def __init__(self, transport_method, user, host, port, auth_user=None, auth_password=None, weight=1,
+                 max_idle=4, breaker=None):
         self.transport_method = transport_method
         self.auth_password = auth_password
         self.auth_user = auth_user
         self.user = user
         self.host = host
         self.port = port
+        self.weight = weight
+        self.breaker = breaker or CircuitBreaker()
+        self.local_address = None
+        self._local = threading.local()
+
+        # Load, as recorded by the requests made through the pool
+        self.outstanding = 0
+        self.requests = 0
+        self.latency = None
+        self.latency_time = None
+        self.stats_lock = threading.Lock()
+
+        auth = ''
+        if self.auth_user and self.auth_password:
+            auth = '{0}:{1}@'.format(self.auth_user, self.auth_password)
+
+        self.transports = TransportPool(self, max_idle)
+        self.proxy = Server(
+            'http://{}{}:{}'.format(auth, self.host, self.port),
+            transport=self.transports
+        )
 
     @property
     def connection_info(self):
         return (self.host, self.port, self.auth_user, self.auth_password)
 
+    alive = True
+    # Result of the last check (servers are taken to be up until then)
+
     @property
     def is_alive(self):
+        return self.alive
+
+    def check(self, timeout=None):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex((self.host, self.port))
+        sock.settimeout(timeout)
+        try:
+            self.alive = sock.connect_ex((self.host, self.port)) == 0
+        except socket.error:
+            self.alive = False
+        finally:
+            sock.close()
 
-        return result == 0
+        return self.alive
 
     @property
     def connection(self):
-        address, user = self.get_transport_info(self.host, self.port)
+        # Worked out here, in the caller's stack, for the requests this
+        # thread makes next
+        self._local.transport_info = self.get_transport_info(self.host, self.port)
+        return self.proxy
+
+    def started(self):
+        with self.stats_lock:
+            self.outstanding += 1
+
+    def finished(self, latency, failed=False):
+        with self.stats_lock:
+            self.outstanding -= 1
+            self.requests += 1
+            now = time.time()
+            if self.latency is None or latency > self.latency:
+                # Peak EWMA: slower responses count straight away
+                self.latency = latency
+            else:
+                weight = math.exp(-(now - self.latency_time) / self.decay)
+                self.latency = self.latency * weight + latency * (1 - weight)
+            self.latency_time = now
+
+        self.breaker.record(failed)
+
+    def cost(self):
+        """ Expected latency of one more request: the latency EWMA times the requests in flight. """
+        with self.stats_lock:
+            if self.latency is None:
+                return self.initial_latency * (self.outstanding + 1)
+
+            weight = math.exp(-(time.time() - self.latency_time) / self.decay)
+            latency = self.latency * weight + self.initial_latency * (1 - weight)
+            return latency * (self.outstanding + 1)
+
+    def request(self, methodname, params, transport_info=None, hedge=None):
+        """
+        A call with the caller's transport info (from another thread),
+        as the first request of a hedge if one is given.
+        """
+        if transport_info is not None:
+            self._local.transport_info = transport_info
+
+        self._local.hedge = hedge
+        try:
+            return self.proxy._request(methodname, params)
+        finally:
+            self._local.hedge = None
 
-        auth = ''
-        if self.auth_user and self.auth_password:
-            auth = '{0}:{1}@'.format(self.auth_user, self.auth_password)
+    def transport_info(self):
+        transport_info = getattr(self._local, 'transport_info', None)
+        if transport_info is None:
+            transport_info = self.get_transport_info(self.host, self.port)
 
-        return Server(
-            'http://{}{}:{}'.format(auth, self.host, self.port),
-            transport=SpecialTransport(user=user, address=address)
-        )
+        return transport_info
+
+    def close(self):
+        self.transports.close()
 
     def get_transport_info(self, host, port):
         if self.transport_method == 'django':
@@ -133,13 +306,15 @@ class Connection(object):
             return self.heisen_transport(host, port)
 
     def heisen_transport(self, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect((host, port))
-        address = s.getsockname()[0]
+        if self.local_address is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.connect((host, port))
+                self.local_address = s.getsockname()[0]
+            finally:
+                s.close()
 
-        user = self.user
-
-        return address, user
+        return self.local_address, self.user
 
     def django_transport(self):
         stack = inspect.stack()
@@ -170,19 +345,521 @@ class Connection(object):
         return ip
 
 
+class CircuitBreaker(object):
+    """
+    Keeps requests away from a failing server.
+
+    closed: requests go through, and the outcomes of the last window
+    are kept. It opens once at least min_requests of them failed, at
+    failure_rate or more.
+    open: no requests, for a backoff that doubles each time it opens
+    again without recovering in between (from base_backoff up to
+    max_backoff), half of it jittered.
+    half_open: once the backoff is over, one probe request every
+    probe_interval seconds; it closes on a success and opens again on a
+    failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    window = 20
+    min_requests = 5
+    failure_rate = 0.5
+    base_backoff = 1.0
+    max_backoff = 60.0
+    probe_interval = 1.0
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=self.window)
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+        self.next_probe = 0
+        self.lock = threading.Lock()
+
+    def _available(self, now):
+        if self.state == self.OPEN and now >= self.open_until:
+            self.state = self.HALF_OPEN
+            self.next_probe = now
+
+        if self.state == self.HALF_OPEN:
+            return now >= self.next_probe
+
+        return self.state == self.CLOSED
+
+    def available(self):
+        """ Whether a request could go through now. """
+        with self.lock:
+            return self._available(time.time())
+
+    def allow(self):
+        """ Like available, but uses up the probe of a half open breaker. """
+        with self.lock:
+            now = time.time()
+            if not self._available(now):
+                return False
+
+            if self.state == self.HALF_OPEN:
+                self.next_probe = now + self.probe_interval
+
+            return True
+
+    def record(self, failed):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if failed:
+                    self._trip()
+                else:
+                    self.state = self.CLOSED
+                    self.trips = 0
+            elif self.state == self.CLOSED:
+                if len(self.outcomes) == self.outcomes.maxlen:
+                    self.failures -= self.outcomes[0]
+
+                self.outcomes.append(failed)
+                self.failures += failed
+                if len(self.outcomes) >= self.min_requests and \
+                        self.failures >= self.failure_rate * len(self.outcomes):
+                    self._trip()
+
+    def _trip(self):
+        self.trips += 1
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.trips - 1))
+        self.open_until = time.time() + backoff / 2 + random.uniform(0, backoff / 2)
+        self.state = self.OPEN
+        self.outcomes.clear()
+        self.failures = 0
+
+
+class RoundRobin(object):
+    def __init__(self):
+        self.counter = count()
+
+    def choose(self, connections):
+        return connections[self.counter.next() % len(connections)]
+
+
+class WeightedRoundRobin(object):
+    """ Smooth weighted round robin (as nginx does it), by each server's weight. """
+
+    def __init__(self):
+        self.current = {}
+        self.lock = threading.Lock()
+
+    def choose(self, connections):
+        with self.lock:
+            total = 0
+            best = None
+            for connection in connections:
+                self.current[connection] = self.current.get(connection, 0) + connection.weight
+                total += connection.weight
+                if best is None or self.current[connection] > self.current[best]:
+                    best = connection
+
+            self.current[best] -= total
+            return best
+
+
+class LeastOutstanding(object):
+    """ The server with the fewest requests in flight (in turn, among equals). """
+
+    def __init__(self):
+        self.counter = count()
+
+    def load(self, connection):
+        return connection.outstanding
+
+    def choose(self, connections):
+        start = self.counter.next() % len(connections)
+        return min(connections[start:] + connections[:start], key=self.load)
+
+
+class PeakEWMA(LeastOutstanding):
+    """ The server with the lowest latency EWMA times requests in flight. """
+
+    def load(self, connection):
+        return connection.cost()
+
+
+class PowerOfTwoChoices(object):
+    """ The less loaded (by peak EWMA cost) of two servers picked at random. """
+
+    def choose(self, connections):
+        if len(connections) < 2:
+            return connections[0]
+
+        first, second = random.sample(connections, 2)
+        if second.cost() < first.cost():
+            return second
+
+        return first
+
+
+balancers = {
+    'round_robin': RoundRobin,
+    'weighted_round_robin': WeightedRoundRobin,
+    'least_outstanding': LeastOutstanding,
+    'peak_ewma': PeakEWMA,
+    'power_of_two_choices': PowerOfTwoChoices,
+}
+
+
+def get_balancer(balancer):
+    if not isinstance(balancer, basestring):
+        return balancer
+
+    try:
+        return balancers[balancer]
+    except KeyError:
+        raise ValueError('Unknown balancer %s.' % balancer)
+
+
+class HedgingProxy(object):
+    """
+    Calls the servers of one name of a pool. A call to one of the
+    methods that the first server hasn't answered within the percentile
+    of the recent latencies goes to a second server as well, and
+    whichever answers first wins. The first request is made on the
+    caller's thread, and only the backup on the pool's hedge_workers;
+    a backup that wins aborts the first request, while a first request
+    that wins leaves the backup to finish, ignored.
+
+    Every call earns budget of a hedge, up to max_tokens saved, so the
+    extra load stays around budget times the calls made.
+    """
+
+    initial_delay = 0.05
+    # Hedge delay until there are min_samples latencies
+    min_delay = 0.001
+    min_samples = 20
+    max_samples = 1000
+    max_tokens = 10
+
+    def __init__(self, pool, server_name, methods, percentile=95, budget=0.1):
+        self.pool = pool
+        self.server_name = server_name
+        self.methods = methods
+        self.percentile = percentile
+        self.budget = budget
+        self.samples = deque(maxlen=self.max_samples)
+        self.delay = self.initial_delay
+        self.tokens = self.max_tokens
+        self.calls = 0
+        self.hedges = 0
+        self.recorded = 0
+        self.lock = threading.Lock()
+
+    def _proxy(self):
+        return self.pool.get_available_server(self.server_name).connection
+
+    @property
+    def _notify(self):
+        return self._proxy()._notify
+
+    def _run_request(self, request, notify=None):
+        return self._proxy()._run_request(request, notify)
+
+    def _run_batch_request(self, request):
+        # So that a MultiCall of the proxy works as it does without hedging
+        return self._proxy()._run_batch_request(request)
+
+    def _request(self, methodname, params):
+        connection = self.pool.get_available_server(self.server_name)
+        if methodname not in self.methods:
+            return connection.connection._request(methodname, params)
+
+        with self.lock:
+            self.calls += 1
+            self.tokens = min(self.max_tokens, self.tokens + self.budget)
+            delay = self.delay
+
+        transport_info = connection.get_transport_info(connection.host, connection.port)
+        hedge = Hedge()
+        self.pool.scheduler.schedule(
+            delay, self._send_backup, hedge, connection, methodname, params, transport_info
+        )
+
+        # The first request runs on the caller's thread, only the backup
+        # goes to the pool
+        start = time.time()
+        try:
+            result = connection.request(methodname, params, transport_info, hedge=hedge)
+        except Exception:
+            exc_info = sys.exc_info()
+            backup = hedge.finish()
+            if backup is None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            # Either it won (and cut this one short), or it may still succeed
+            del exc_info
+            return backup.result()
+
+        hedge.finish()
+        self._record(time.time() - start)
+        return result
+
+    def _send_backup(self, hedge, primary, methodname, params, transport_info):
+        with hedge.lock:
+            if hedge.finished:
+                return
+
+            backup = self._get_backup(primary)
+            if backup is None:
+                return
+
+            start = time.time()
+            hedge.backup = self.pool.hedge_pool.submit(backup.request, methodname, params, transport_info)
+
+        def done(future):
+            if future.exception() is None:
+                self._record(time.time() - start)
+                hedge.abort()
+
+        hedge.backup.add_done_callback(done)
+
+    def _get_backup(self, primary):
+        with self.lock:
+            if self.tokens < 1:
+                return None
+
+            connections = [
+                connection for connection in self.pool.connections[self.server_name]
+                if connection is not primary and connection.is_alive and connection.breaker.available()
+            ]
+            if not connections:
+                return None
+
+            backup = min(connections, key=lambda connection: connection.cost())
+            if not backup.breaker.allow():
+                return None
+
+            self.tokens -= 1
+            self.hedges += 1
+            return backup
+
+    def _record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+            self.recorded += 1
+            count = len(self.samples)
+            # Worked out again every min_samples latencies
+            if count >= self.min_samples and self.recorded % self.min_samples == 0:
+                latencies = sorted(self.samples)
+                index = min(count - 1, int(count * self.percentile / 100.0))
+                self.delay = max(self.min_delay, latencies[index])
+
+    def __getattr__(self, name):
+        return _Method(self._request, name)
+
+
+class Hedge(object):
+    """
+    One hedged call: the first request, made by the caller, and the
+    backup request (a Future) if one was sent. A backup that succeeds
+    first aborts the first request, by shutting its socket down.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = False
+        self.aborted = False
+        self.transport = None
+        self.backup = None
+
+    def attach(self, transport):
+        with self.lock:
+            self.transport = transport
+            if self.aborted:
+                transport.abort()
+
+    def detach(self, transport):
+        """ Whether the transport can be used again. """
+        with self.lock:
+            self.transport = None
+            return not transport.aborted
+
+    def finish(self):
+        """ Marks the first request done, and returns the backup, if any. """
+        with self.lock:
+            self.finished = True
+            return self.backup
+
+    def abort(self):
+        with self.lock:
+            if self.finished:
+                return
+
+            self.aborted = True
+            if self.transport is not None:
+                self.transport.abort()
+
+
+class Scheduler(threading.Thread):
+    """ Runs functions after a delay, one after the other, on one thread. """
+
+    def __init__(self, name='jsonrpclib-scheduler'):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.calls = []
+        self.counter = count()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def schedule(self, delay, func, *args):
+        with self.condition:
+            heapq.heappush(self.calls, (time.time() + delay, self.counter.next(), func, args))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    now = time.time()
+                    if self.calls and self.calls[0][0] <= now:
+                        break
+
+                    self.condition.wait(self.calls[0][0] - now if self.calls else None)
+
+                if self.stopped:
+                    return
+
+                when, i, func, args = heapq.heappop(self.calls)
+
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Scheduled call failed')
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+class HealthChecker(threading.Thread):
+    """
+    Runs the pool's check_servers every interval seconds, until it's
+    stopped or the pool is gone.
+    """
+
+    def __init__(self, pool, interval):
+        threading.Thread.__init__(self, name='jsonrpclib-health-checker')
+        self.daemon = True
+        self.pool = weakref.ref(pool)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            pool = self.pool()
+            if pool is None:
+                return
+            try:
+                pool.check_servers()
+            except Exception:
+                logger.exception('Checking the servers failed')
+            del pool
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class TransportPool(object):
+    """
+    The transport of a ServerProxy shared by threads. Each request
+    borrows an idle SpecialTransport (with its kept-alive socket), or
+    makes a new one, and gives it back once the response is read --
+    keeping at most max_idle of them.
+    """
+
+    def __init__(self, connection, max_idle=4):
+        self.connection = connection
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, host, handler, request_body, verbose=0):
+        address, user = self.connection.transport_info()
+        with self.lock:
+            transport = self.idle.pop() if self.idle else None
+
+        if transport is None:
+            transport = SpecialTransport()
+
+        transport.user = user
+        transport.address = address
+        hedge = getattr(self.connection._local, 'hedge', None)
+        if hedge is not None:
+            hedge.attach(transport)
+
+        self.connection.started()
+        start = time.time()
+        try:
+            response = transport.request(host, handler, request_body, verbose)
+        except:
+            # Cut short by a hedge isn't the server's fault
+            self.connection.finished(time.time() - start, failed=not transport.aborted)
+            if hedge is not None:
+                hedge.detach(transport)
+
+            transport.close()
+            raise
+
+        self.connection.finished(time.time() - start)
+        reuse = hedge is None or hedge.detach(transport)
+
+        with self.lock:
+            if reuse and len(self.idle) < self.max_idle:
+                self.idle.append(transport)
+                transport = None
+
+        if transport is not None:
+            transport.close()
+
+        return response
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for transport in idle:
+            transport.close()
+
+
 class SpecialTransport(Transport):
+    aborted = False
+
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop('user', None)
         self.address = kwargs.pop('address', None)
         super(SpecialTransport, self).__init__(*args, **kwargs)
 
+    def make_connection(self, host):
+        if self.aborted:
+            # Instead of xmlrpclib retrying the request on a new connection
+            raise socket.error(errno.ECONNABORTED, 'Request aborted')
+
+        return super(SpecialTransport, self).make_connection(host)
+
+    def abort(self):
+        """ Stops the request in progress (from another thread). """
+        self.aborted = True
+        for connection, extra_headers, last_used in self._connections.values():
+            if connection.sock is not None:
+                try:
+                    connection.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
     def send_content(self, connection, request_body):
         connection.putheader("X-User", self.user)
         connection.putheader("X-Address", self.address)
         connection.putheader("Content-Length", str(len(request_body)))
-        connection.endheaders()
-        if request_body:
-            connection.send(request_body)
+        connection.endheaders(request_body)
 
 
 class NoServer(Exception):
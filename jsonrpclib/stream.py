@@ -0,0 +1,121 @@
+"""
+Incremental splitting of JSON-RPC batches, so that the entries of a
+large batch can be handled while the rest of it is still being read
+(or before the rest of it is decoded).
+"""
+
+import re
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER_START = '-0123456789'
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+RESCAN_SIZE = 64 * 1024
+# A partial element up to this size is rescanned on every feed, a
+# bigger one only once the buffered text has doubled.
+
+
+class BatchSplitter(object):
+    """
+    Fed the text of a JSON document in chunks, hands back the text of
+    each element of a top-level array as soon as it is complete. The
+    element boundaries are found with the C scanner (raw_decode), and
+    a large partial element is only retried once the buffered text
+    doubled, so it isn't rescanned for every chunk.
+
+    Anything other than an array is just collected, and available as
+    .document once all of it has been fed.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.parts = []
+        self.size = 0
+        self.retry_size = 0
+        self.is_array = None
+        self.count = 0
+        self._expect_value = True
+        self._first = True
+        self._done = False
+
+    @property
+    def document(self):
+        return ''.join(self.parts)
+
+    def feed(self, data):
+        if not data:
+            return []
+        self.parts.append(data)
+        self.size += len(data)
+        if self.is_array is False or self.size < self.retry_size:
+            return []
+        return self._split(final=False)
+
+    def close(self):
+        """
+        Returns the remaining elements, and raises ValueError if the
+        array is invalid or incomplete.
+        """
+        if self.is_array is False:
+            return []
+        elements = self._split(final=True)
+        if self.is_array and not self._done:
+            raise ValueError('Batch is incomplete.')
+        return elements
+
+    def _split(self, final):
+        buf = ''.join(self.parts)
+        pos = WHITESPACE.match(buf).end()
+        if self.is_array is None:
+            if pos == len(buf):
+                return []
+            self.is_array = buf[pos] == '['
+            if not self.is_array:
+                return []
+            pos += 1
+        elements = []
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if self._done:
+                raise ValueError('Extra data after the batch.')
+            char = buf[pos]
+            if char == ']' and (self._first or not self._expect_value):
+                self._done = True
+                pos += 1
+                continue
+            if not self._expect_value:
+                if char != ',':
+                    raise ValueError('Expected , or ] in batch.')
+                self._expect_value = True
+                pos += 1
+                continue
+            try:
+                end = self.decoder.raw_decode(buf, pos)[1]
+            except ValueError:
+                if final:
+                    raise
+                # Most likely not all there yet
+                break
+            if char in NUMBER_START and not final and \
+                    NUMBER_TAIL.match(buf, end).end() == len(buf):
+                # The number could go on in the next chunk
+                break
+            elements.append(buf[pos:end])
+            self.count += 1
+            self._first = False
+            self._expect_value = False
+            pos = end
+        rest = buf[pos:]
+        self.parts = rest and [rest] or []
+        self.size = len(rest)
+        if self.size > RESCAN_SIZE:
+            self.retry_size = self.size * 2
+        else:
+            self.retry_size = 0
+        return elements
@@ -0,0 +1,195 @@
+"""
+A small bounded thread pool and the Future objects it hands out.
+
+The pool starts threads lazily up to max_workers, and refuses new work
+with PoolFull once max_queue jobs are already waiting for a thread
+(max_queue=0 means the queue is unbounded).
+"""
+
+import Queue
+import sys
+import threading
+
+
+class PoolFull(Exception):
+    """ Raised by WorkerPool.submit when the job queue is full. """
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    """
+    The eventual result of a job: either a value, or the exc_info of
+    the exception it raised, which result() re-raises.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError('Result not available after %s seconds.' %
+                               timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError('Result not available after %s seconds.' %
+                               timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info=None):
+        if exc_info is None:
+            exc_info = sys.exc_info()
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class WorkerPool(object):
+
+    def __init__(self, max_workers=10, max_queue=0, name='jsonrpclib'):
+        if max_workers < 1:
+            raise ValueError('A pool needs at least one worker.')
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue.Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        try:
+            self._queue.put_nowait((future, func, args, kwargs))
+        except Queue.Full:
+            raise PoolFull('Too many jobs waiting for a worker.')
+        self._adjust_workers()
+        return future
+
+    def _adjust_workers(self):
+        with self._lock:
+            if len(self._threads) >= self.max_workers:
+                return
+            thread = threading.Thread(
+                target=self._work,
+                name='%s-worker-%d' % (self.name, len(self._threads)))
+            thread.daemon = True
+            self._threads.append(thread)
+        thread.start()
+
+    def _work(self):
+        while True:
+            if self._shutdown:
+                # Runs what's left, without waiting for more
+                try:
+                    job = self._queue.get_nowait()
+                except Queue.Empty:
+                    return
+            else:
+                job = self._queue.get()
+            if job is None:
+                return
+            future, func, args, kwargs = job
+            try:
+                result = func(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+            del job, future, func, args, kwargs
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._shutdown = True
+        for thread in threads:
+            # Wakes up an idle worker. Goes to the back of the queue, so
+            # pending jobs still run; once it's full, the workers are
+            # busy and will see _shutdown when they're done.
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                break
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class SingleFlight(object):
+    """
+    Runs one call per key at a time. A call made with a key that's
+    already running waits for that one instead, and gets its result
+    (or exception) too.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, func, *args, **kwargs):
+        with self._lock:
+            running = self._calls.get(key)
+            if running is None:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if running is not None:
+            return running.result()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            with self._lock:
+                del self._calls[key]
+            future.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        with self._lock:
+            del self._calls[key]
+        future.set_result(result)
+        return result
+
+
+def coalesced(function):
+    """
+    Marks a function or method served by a SimpleJSONRPCServer so that
+    identical calls (same params) running at the same time are
+    coalesced into one, whose result they all get.
+    """
+    function.coalesce = True
+    return function
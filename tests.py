@@ -19,11 +19,15 @@ try:
     import json
 except ImportError:
     import simplejson as json
+import datetime
+import httplib
 import os
+import signal
 import socket
 import sys
 import tempfile
-from threading import Thread
+import time
+from threading import Event, Thread
 
 if sys.version_info < (2, 7):
     import unittest2 as unittest
@@ -31,9 +35,24 @@ else:
     import unittest
 
 from jsonrpclib import Server, MultiCall, history, ProtocolError
+from jsonrpclib.jsonrpc import MultiCallIterator
+from jsonrpclib import AsyncServerProxy, BatchingServerProxy
+from jsonrpclib import RawJSON
+from jsonrpclib import ResponseCache
+from jsonrpclib.cache import cached
 from jsonrpclib import jsonrpc
+from jsonrpclib import codec
+from jsonrpclib import config
+from jsonrpclib import jsonclass
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCRequestHandler
+from jsonrpclib.SimpleJSONRPCServer import ThreadedJSONRPCServer
+from jsonrpclib.SimpleJSONRPCServer import ForkingJSONRPCServer
+from jsonrpclib.SimpleJSONRPCServer import PreforkJSONRPCServer
+from jsonrpclib.AsyncJSONRPCServer import AsyncJSONRPCServer
+from jsonrpclib.workers import WorkerPool, PoolFull, SingleFlight
+from jsonrpclib.request import ConnectionPool, Connection, NoServer
+from jsonrpclib.request import get_balancer, CircuitBreaker
 
 
 def get_port(family=socket.AF_INET):
@@ -357,6 +376,46 @@ class InternalTests(unittest.TestCase):
                 with self.assertRaises(raises[i]):
                     func()
 
+    def test_raw_json(self):
+        client = self.get_client()
+        self.assertTrue(client.get_raw_data() == ['hello', 5])
+        multicall = self.get_multicall_client()
+        multicall.get_raw_data()
+        multicall.get_data()
+        result = multicall()
+        self.assertTrue(result[0] == result[1])
+        response = jsonrpc.dumps(
+            RawJSON('{"a": 1}'), methodresponse=True, rpcid='x')
+        self.assertTrue(json.loads(response) == {
+            'jsonrpc': '2.0', 'id': 'x', 'result': {'a': 1}})
+
+    def test_raw_json_unicode(self):
+        client = self.get_client()
+        self.assertTrue(client.get_raw_unicode() == [u'caf\xe9'])
+        multicall = self.get_multicall_client()
+        multicall.get_raw_unicode()
+        multicall.get_data()
+        self.assertTrue(list(multicall()) == [[u'caf\xe9'], ['hello', 5]])
+
+    def test_envelopes(self):
+        for version in (1.0, 2.0):
+            payload = jsonrpc.Payload(rpcid='x', version=version)
+            for data, expected in (
+                    (jsonrpc.dumps([1, 2], 'add', rpcid='x', version=version),
+                     payload.request('add', [1, 2])),
+                    (jsonrpc.dumps([], 'ping', rpcid='x', version=version),
+                     payload.request('ping')),
+                    (jsonrpc.dumps({'a': 1}, 'add', notify=True,
+                                   version=version),
+                     payload.notify('add', {'a': 1})),
+                    (jsonrpc.dumps([3], methodresponse=True, rpcid='x',
+                                   version=version),
+                     payload.response([3])),
+                    (jsonrpc.Fault(-32601, 'Nope').response(
+                        rpcid='x', version=version),
+                     payload.error(-32601, 'Nope'))):
+                self.assertTrue(json.loads(data) == expected)
+
     def test_proxy_object_reuse_is_allowed(self):
         client = self.get_client()
         sub_service_proxy = client.sub_service
@@ -419,6 +478,1412 @@ class UnixSocketErrorTests(unittest.TestCase):
         jsonrpc.USE_UNIX_SOCKETS = self.original_value
 
 
+class KeepAliveServer(SimpleJSONRPCServer):
+    keep_alive = True
+    max_keep_alive_requests = 3
+
+
+class KeepAliveTests(unittest.TestCase):
+    """
+    Persistent connections between the client transport and a
+    server with keep_alive turned on.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.server = server_set_up(
+            addr=('', self.port), server_class=KeepAliveServer)
+        self.client = Server('http://localhost:%d' % self.port)
+        self.transport = self.client._ServerProxy__transport
+
+    def tearDown(self):
+        self.transport.close()
+
+    def get_socket(self):
+        host = 'localhost:%d' % self.port
+        return self.transport._connections[host][0].sock
+
+    def test_connection_reused(self):
+        self.assertTrue(self.client.add(1, 2) == 3)
+        sock = self.get_socket()
+        self.assertTrue(sock is not None)
+        self.assertTrue(self.client.add(3, 4) == 7)
+        self.assertTrue(self.get_socket() is sock)
+
+    def test_max_requests(self):
+        for i in range(3):
+            self.client.ping()
+        # The server closed the connection after the third request
+        self.assertTrue(self.get_socket() is None)
+        self.assertTrue(self.client.add(1, 2) == 3)
+        self.assertTrue(self.get_socket() is not None)
+
+    def test_default_server_closes(self):
+        port = get_port()
+        server_set_up(addr=('', port))
+        client = Server('http://localhost:%d' % port)
+        self.assertTrue(client.ping())
+        transport = client._ServerProxy__transport
+        connection = transport._connections['localhost:%d' % port][0]
+        self.assertTrue(connection.sock is None)
+
+
+class SmallPoolServer(ThreadedJSONRPCServer):
+    max_workers = 1
+    max_queue = 1
+
+
+class ThreadedServerTests(unittest.TestCase):
+    """
+    A slow method on the pooled server holds up its own connection
+    only, and connections beyond the queue limit are turned away.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.started = Event()
+        self.release = Event()
+        self.server = SmallPoolServer(('', self.port), logRequests=False)
+        self.server.register_function(self.wait, 'wait')
+        self.server.register_function(lambda: True, 'ping')
+        server_proc = Thread(target=self.server.serve_forever)
+        server_proc.daemon = True
+        server_proc.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait(self):
+        self.started.set()
+        self.release.wait(10)
+        return 'done'
+
+    def get_client(self):
+        return Server('http://localhost:%d' % self.port)
+
+    def call_in_thread(self, method, results):
+        def run():
+            results.append(getattr(self.get_client(), method)())
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_busy(self):
+        results = []
+        slow = self.call_in_thread('wait', results)
+        self.assertTrue(self.started.wait(5))
+        queued = self.call_in_thread('ping', results)
+        # Give the acceptor time to queue the second connection
+        time.sleep(0.2)
+        with self.assertRaises(ProtocolError) as context:
+            self.get_client().ping()
+        self.assertTrue(context.exception.args[0][0] == -32001)
+        self.release.set()
+        slow.join(5)
+        queued.join(5)
+        self.assertTrue(results == ['done', True])
+
+    def test_concurrent(self):
+        # The pool is only created for the first connection
+        self.server.max_workers = 2
+        results = []
+        slow = self.call_in_thread('wait', results)
+        self.assertTrue(self.started.wait(5))
+        self.assertTrue(self.get_client().ping())
+        self.release.set()
+        slow.join(5)
+        self.assertTrue(results == ['done'])
+
+    def test_idle_connection_released(self):
+        idle = self.get_client()
+        self.assertTrue(idle.ping())
+        # The only worker now waits for idle's next request, until
+        # another connection comes in
+        start = time.time()
+        self.assertTrue(self.get_client().ping())
+        self.assertTrue(time.time() - start < 1)
+        idle._ServerProxy__transport.close()
+
+
+class RecordingPoolServer(ThreadedJSONRPCServer):
+
+    def handle_error(self, request, client_address):
+        self.errors.append(sys.exc_info()[1])
+
+
+class PooledServerCloseTests(unittest.TestCase):
+    """
+    Closing a pooled server lets go of its idle kept-alive connections.
+    """
+
+    def test_close_with_idle_connections(self):
+        for run in range(50):
+            port = get_port()
+            server = RecordingPoolServer(('', port), logRequests=False)
+            server.errors = []
+            server.register_function(lambda: True, 'ping')
+            server_proc = Thread(target=server.serve_forever,
+                                 kwargs={'poll_interval': 0.01})
+            server_proc.daemon = True
+            server_proc.start()
+            clients = [Server('http://localhost:%d' % port) for i in range(8)]
+            for client in clients:
+                self.assertTrue(client.ping())
+            server.shutdown()
+            server.server_close()
+            for client in clients:
+                transport = client._ServerProxy__transport
+                sock = transport._connections['localhost:%d' % port][0].sock
+                sock.settimeout(5)
+                # Closed by the server, well before keep_alive_timeout
+                self.assertTrue(sock.recv(1) == '')
+                transport.close()
+            for i in range(100):
+                if server.wakeup is None:
+                    break
+                time.sleep(0.05)
+            self.assertTrue(server.wakeup is None)
+            self.assertTrue(server.errors == [])
+
+
+class WorkerPoolTests(unittest.TestCase):
+    """
+    The bounded thread pool behind ThreadedJSONRPCServer.
+    """
+
+    def test_shutdown_with_full_queue(self):
+        pool = WorkerPool(max_workers=1, max_queue=1)
+        started = Event()
+        release = Event()
+        first = pool.submit(lambda: started.set() or release.wait(5))
+        self.assertTrue(started.wait(5))
+        second = pool.submit(lambda: 'second')
+        with self.assertRaises(PoolFull):
+            pool.submit(int)
+        start = time.time()
+        pool.shutdown(wait=False)
+        self.assertTrue(time.time() - start < 1)
+        release.set()
+        # Pending jobs still run
+        self.assertTrue(first.result(5) is True)
+        self.assertTrue(second.result(5) == 'second')
+
+
+class SmallForkingServer(ForkingJSONRPCServer):
+    max_children = 1
+    # The children inherit the client's end of the connection from the
+    # test runner, so they never see it closed
+    keep_alive_timeout = 0.2
+
+
+class ForkingServerTests(unittest.TestCase):
+    """
+    Connections beyond max_children are turned away, until a child is
+    done with its connection.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.server = SmallForkingServer(('', self.port), logRequests=False)
+        self.server.register_function(lambda: time.sleep(0.5) or 'done', 'wait')
+        self.server.register_function(lambda: True, 'ping')
+        server_proc = Thread(target=self.server.serve_forever)
+        server_proc.daemon = True
+        server_proc.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_client(self):
+        return Server('http://localhost:%d' % self.port)
+
+    def test_busy_then_reused(self):
+        results = []
+
+        def run():
+            results.append(self.get_client().wait())
+        slow = Thread(target=run)
+        slow.daemon = True
+        slow.start()
+        time.sleep(0.2)
+        with self.assertRaises(ProtocolError) as context:
+            self.get_client().ping()
+        self.assertTrue(context.exception.args[0][0] == -32001)
+        slow.join(5)
+        self.assertTrue(results == ['done'])
+        deadline = time.time() + 2
+        while True:
+            try:
+                self.assertTrue(self.get_client().ping())
+                break
+            except ProtocolError:
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.05)
+
+
+class PreforkTests(unittest.TestCase):
+    """
+    Runs a prefork server (master and workers) in a child process of
+    the test runner.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                server = PreforkJSONRPCServer(
+                    ('', self.port), logRequests=False)
+                server.workers = 2
+                server.register_function(os.getpid, 'getpid')
+                server.register_function(lambda: os._exit(1), 'crash')
+                server.register_function(lambda: True, 'ping')
+                server.serve_forever(poll_interval=0.05)
+            finally:
+                os._exit(0)
+        for i in range(100):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if sock.connect_ex(('localhost', self.port)) == 0:
+                sock.close()
+                break
+            sock.close()
+            time.sleep(0.05)
+
+    def tearDown(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+
+    def get_pids(self, calls=10):
+        return set([self.get_client().getpid() for i in range(calls)])
+
+    def get_client(self):
+        return Server('http://localhost:%d' % self.port)
+
+    def test_workers(self):
+        pids = self.get_pids()
+        self.assertTrue(self.pid not in pids)
+        self.assertTrue(len(pids) <= 2)
+
+    def get_workers(self):
+        workers = set()
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % name) as stat:
+                    fields = stat.read().rsplit(')', 1)[1].split()
+            except (IOError, IndexError):
+                # Gone already
+                continue
+            if int(fields[1]) == self.pid:
+                workers.add(int(name))
+        return workers
+
+    @unittest.skipIf(not os.path.isdir('/proc'), 'Needs /proc')
+    def test_crashed_worker_replaced(self):
+        for i in range(100):
+            workers = self.get_workers()
+            if len(workers) == 2:
+                break
+            time.sleep(0.05)
+        self.assertTrue(len(workers) == 2)
+        # (The transport retries once, so both workers may crash)
+        with self.assertRaises(Exception):
+            self.get_client().crash()
+        for i in range(100):
+            replaced = self.get_workers()
+            if len(replaced) == 2 and not replaced <= workers:
+                break
+            time.sleep(0.05)
+        self.assertTrue(len(replaced) == 2)
+        self.assertTrue(replaced != workers)
+        self.assertTrue(self.get_client().ping())
+
+    def test_reload(self):
+        pids = self.get_pids()
+        os.kill(self.pid, signal.SIGHUP)
+        time.sleep(0.5)
+        self.assertTrue(not pids & self.get_pids())
+
+
+class AsyncServerTests(unittest.TestCase):
+    """
+    The event driven server, including handlers answering with a
+    Future.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.pool = WorkerPool(max_workers=2)
+        self.release = Event()
+        self.server = server_set_up(
+            addr=('', self.port), server_class=AsyncJSONRPCServer)
+        self.server.register_function(
+            lambda: self.pool.submit(self.release.wait, 5), 'wait')
+        self.server.register_function(
+            lambda: self.pool.submit(int, 'x'), 'fail')
+        self.called = Event()
+        self.server.register_function(
+            lambda: self.called.set() or True, 'signal')
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.shutdown()
+
+    def get_client(self):
+        return Server('http://localhost:%d' % self.port)
+
+    def test_single(self):
+        client = self.get_client()
+        self.assertTrue(client.add(5, 10) == 15)
+        self.assertTrue(client.add(x=5, y=10) == 15)
+        self.assertTrue(client.namespace.sum(1, 2, 4) == 7)
+        self.assertTrue(client._notify.add(5, 10) is None)
+
+    def test_future(self):
+        self.release.set()
+        self.assertTrue(self.get_client().wait() is True)
+
+    def test_future_does_not_block(self):
+        results = []
+
+        def wait():
+            results.append(self.get_client().wait())
+        thread = Thread(target=wait)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(self.get_client().add(1, 2) == 3)
+        self.assertTrue(results == [])
+        self.release.set()
+        thread.join(5)
+        self.assertTrue(results == [True])
+
+    def test_future_failure(self):
+        with self.assertRaises(Exception):
+            self.get_client().fail()
+
+    def test_future_in_batch(self):
+        self.release.set()
+        multicall = MultiCall(self.get_client())
+        multicall.add(1, 2)
+        multicall.wait()
+        multicall._notify.wait()
+        multicall.add(3, 4)
+        self.assertTrue(list(multicall()) == [3, True, 7])
+
+    def send_raw(self, path, body):
+        body += '\r\n\r\n'
+        sock = socket.create_connection(('localhost', self.port), 5)
+        sock.sendall('POST %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' %
+                     (path, len(body), body))
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        sock.close()
+        return response
+
+    def test_refused_body_ignored(self):
+        body = json.dumps({'jsonrpc': '2.0', 'method': 'signal', 'id': 1})
+        response = self.send_raw('/nope', body)
+        self.assertTrue(response.startswith('HTTP/1.1 404'))
+        self.assertTrue(not self.called.wait(0.2))
+
+    def test_too_large_body_ignored(self):
+        self.server.max_request_size = 16
+        body = json.dumps({'jsonrpc': '2.0', 'method': 'signal', 'id': 1})
+        response = self.send_raw('/', body)
+        self.assertTrue(response.startswith('HTTP/1.1 413'))
+        self.assertTrue(not self.called.wait(0.2))
+
+    def test_connection_reused(self):
+        client = self.get_client()
+        client.ping()
+        transport = client._ServerProxy__transport
+        sock = transport._connections['localhost:%d' % self.port][0].sock
+        client.ping()
+        self.assertTrue(
+            transport._connections['localhost:%d' % self.port][0].sock
+            is sock)
+
+
+class AsyncProxyTests(unittest.TestCase):
+    """
+    Calls through the AsyncServerProxy are in flight concurrently.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.server = server_set_up(
+            addr=('', self.port), server_class=ThreadedJSONRPCServer)
+        self.server.register_function(
+            lambda seconds: time.sleep(seconds) or seconds, 'sleep')
+        self.proxy = AsyncServerProxy(
+            'http://localhost:%d' % self.port, max_connections=10)
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_calls(self):
+        futures = [self.proxy.add(i, 1) for i in range(20)]
+        self.assertTrue([future.result(5) for future in futures] ==
+                        range(1, 21))
+        self.assertTrue(self.proxy.namespace.sum(1, 2).result(5) == 3)
+        self.assertTrue(self.proxy._notify.add(1, 2).result(5) is None)
+
+    def test_concurrent(self):
+        start = time.time()
+        futures = [self.proxy.sleep(0.2) for i in range(10)]
+        for future in futures:
+            self.assertTrue(future.result(5) == 0.2)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_error(self):
+        future = self.proxy.foobar()
+        with self.assertRaises(ProtocolError):
+            future.result(5)
+
+    def test_close(self):
+        transports = []
+
+        def factory():
+            transport = jsonrpc.Transport()
+            transports.append(transport)
+            return transport
+        proxy = AsyncServerProxy('http://localhost:%d' % self.port,
+                                 transport_factory=factory)
+        futures = [proxy.sleep(0.1) for i in range(5)]
+        for future in futures:
+            future.result(5)
+        self.assertTrue(len(transports) > 1)
+        proxy.close()
+        for transport in transports:
+            self.assertTrue(not transport._connections)
+
+
+class ParallelBatchServer(ThreadedJSONRPCServer):
+    batch_workers = 10
+
+
+class CountingTransport(jsonrpc.Transport):
+    requests = []
+
+    def request(self, host, handler, request_body, verbose=0):
+        self.requests.append(request_body)
+        return jsonrpc.Transport.request(
+            self, host, handler, request_body, verbose)
+
+
+class BatchingProxyTests(unittest.TestCase):
+    """
+    Calls from several threads sent as batches.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.server = server_set_up(addr=('', self.port))
+        CountingTransport.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_proxy(self, **kwargs):
+        return BatchingServerProxy(
+            'http://localhost:%d' % self.port,
+            transport_factory=CountingTransport, **kwargs)
+
+    def test_batched_calls(self):
+        proxy = self.get_proxy(max_batch=5, window=1)
+        results = {}
+
+        def call(i):
+            results[i] = proxy.add(i, 1)
+        threads = [Thread(target=call, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(results == dict((i, i + 1) for i in range(10)))
+        self.assertTrue(len(CountingTransport.requests) == 2)
+
+    def test_window(self):
+        proxy = self.get_proxy(window=0.01)
+        self.assertTrue(proxy.add(2, 3) == 5)
+        proxy._notify.add(1, 1)
+        with self.assertRaises(ProtocolError):
+            proxy.nothing()
+        self.assertTrue(len(CountingTransport.requests) == 3)
+        self.assertTrue(json.loads(CountingTransport.requests[1]) == [{
+            'jsonrpc': '2.0', 'method': 'add', 'params': [1, 1]}])
+
+
+class ParallelBatchTests(unittest.TestCase):
+    """
+    Batch entries and notifications dispatched on the batch pool.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.release = Event()
+        self.server = server_set_up(
+            addr=('', self.port), server_class=ParallelBatchServer)
+        self.server.register_function(
+            lambda seconds: time.sleep(seconds) or seconds, 'sleep')
+        self.server.register_function(
+            lambda: self.release.wait(5), 'wait')
+        self.client = Server('http://localhost:%d' % self.port)
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_parallel(self):
+        multicall = MultiCall(self.client)
+        for i in range(5):
+            multicall.sleep(0.2)
+        multicall.add(1, 2)
+        start = time.time()
+        self.assertTrue(list(multicall()) == [0.2] * 5 + [3])
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_order_and_errors(self):
+        multicall = MultiCall(self.client)
+        multicall.sleep(0.1)
+        multicall.foobar()
+        multicall._notify.add(1, 2)
+        multicall.add(3, 4)
+        result = multicall()
+        self.assertTrue(len(result) == 3)
+        self.assertTrue(result[0] == 0.1)
+        with self.assertRaises(ProtocolError):
+            result[1]
+        self.assertTrue(result[2] == 7)
+
+    def test_notifications_not_waited_for(self):
+        multicall = MultiCall(self.client)
+        multicall._notify.wait()
+        multicall.add(1, 2)
+        self.assertTrue(list(multicall()) == [3])
+        self.assertTrue(self.client._notify.wait() is None)
+        self.assertFalse(self.release.is_set())
+
+    def test_concurrency_cap(self):
+        self.server.max_batch_concurrency = 1
+        multicall = MultiCall(self.client)
+        for i in range(3):
+            multicall.sleep(0.1)
+        start = time.time()
+        self.assertTrue(list(multicall()) == [0.1] * 3)
+        self.assertTrue(time.time() - start >= 0.3)
+
+
+class ChunkedBatchTests(unittest.TestCase):
+    """
+    Batch responses streamed with chunked encoding, and read as they
+    arrive by MultiCall.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.release = Event()
+        self.server = server_set_up(
+            addr=('', self.port), server_class=ParallelBatchServer)
+        self.server.register_function(
+            lambda: self.release.wait(5), 'wait')
+        self.client = Server('http://localhost:%d' % self.port)
+        self.transport = self.client._ServerProxy__transport
+
+    def tearDown(self):
+        self.release.set()
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, body, version='HTTP/1.1'):
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=5)
+        connection._http_vsn_str = version
+        connection.request('POST', '/', body)
+        response = connection.getresponse()
+        content = response.read()
+        connection.close()
+        return response, content
+
+    def test_chunked(self):
+        body = json.dumps([
+            {'jsonrpc': '2.0', 'method': 'add', 'params': [1, 2], 'id': 1},
+            {'jsonrpc': '2.0', 'method': 'ping', 'id': 2}])
+        response, content = self.post(body)
+        self.assertTrue(response.getheader('transfer-encoding') == 'chunked')
+        self.assertTrue(
+            [r['result'] for r in json.loads(content)] == [3, True])
+        response, content = self.post(body, version='HTTP/1.0')
+        self.assertTrue(response.getheader('transfer-encoding') is None)
+        self.assertTrue(
+            [r['result'] for r in json.loads(content)] == [3, True])
+
+    def test_results_as_they_arrive(self):
+        multicall = MultiCall(self.client)
+        multicall.add(1, 2)
+        multicall.wait()
+        result = iter(multicall())
+        self.assertTrue(result.next() == 3)
+        self.assertFalse(self.release.is_set())
+        self.release.set()
+        self.assertTrue(result.next() is True)
+        self.assertTrue(list(result) == [])
+
+    def test_only_notifications(self):
+        multicall = MultiCall(self.client)
+        multicall._notify.add(1, 2)
+        self.assertTrue(list(multicall()) == [])
+        self.assertTrue(self.client.add(1, 2) == 3)
+
+    def test_call_before_batch_is_read(self):
+        self.release.set()
+        multicall = MultiCall(self.client)
+        for i in range(100):
+            multicall.add(i, i)
+        result = multicall()
+        self.assertTrue(result[0] == 0)
+        # Reads the rest of the batch first, on the same connection
+        self.assertTrue(self.client.add(1, 2) == 3)
+        self.assertTrue(len(result) == 100)
+        self.assertTrue(list(result) == [i * 2 for i in range(100)])
+
+
+class MultiCallIteratorTests(unittest.TestCase):
+    """
+    Results of a batch decoded as they're used.
+    """
+
+    def entries(self, read):
+        yield '{"jsonrpc": "2.0", "result": 1, "id": "a"}'
+        read.append(1)
+        yield '{"jsonrpc": "2.0", "result": [2], "id": "b"}'
+        read.append(2)
+        yield 'not even json'
+
+    def test_decoded_when_used(self):
+        read = []
+        result = MultiCallIterator(self.entries(read))
+        self.assertTrue(result[0] == 1)
+        self.assertTrue(read == [])
+        self.assertTrue(result[1] == [2])
+        self.assertTrue(read == [1])
+        with self.assertRaises(ValueError):
+            result[2]
+        self.assertTrue(len(result) == 3)
+
+    def test_stop_early(self):
+        read = []
+        for item in MultiCallIterator(self.entries(read)):
+            break
+        self.assertTrue(item == 1)
+        self.assertTrue(read == [])
+
+    def test_decoded_results(self):
+        result = MultiCallIterator([
+            {'jsonrpc': '2.0', 'result': 1, 'id': 'a'},
+            '{"jsonrpc": "2.0", "result": 2, "id": "b"}'])
+        self.assertTrue(list(result) == [1, 2])
+        self.assertTrue(result[-1] == 2)
+
+
+class Point(object):
+    _ignore = ['cache']
+
+    def __init__(self, x=0, y=0):
+        self.x = x
+        self.y = y
+        self.cache = {}
+
+
+class Vector(Point):
+
+    def _serialize(self):
+        return [self.x, self.y], {}
+
+
+class JSONClassTests(unittest.TestCase):
+    """
+    Translation of class instances by jsonclass.dump and load.
+    """
+
+    def tearDown(self):
+        config.serialize_method = '_serialize'
+        config.codec = 'fast'
+
+    def test_dump(self):
+        result = jsonclass.dump([Point(1, 2), {'v': Vector(3, 4)}])
+        self.assertTrue(result == [
+            {'__jsonclass__': ['tests.Point', []], 'x': 1, 'y': 2},
+            {'v': {'__jsonclass__': ['tests.Vector', [3, 4]]}}])
+
+    def test_ignore(self):
+        point = Point(1, 2)
+        point.z = 3
+        result = jsonclass.dump(point, ignore=['z'])
+        self.assertTrue(result == {
+            '__jsonclass__': ['tests.Point', []], 'x': 1, 'y': 2})
+
+    def test_config_change(self):
+        self.assertTrue(jsonclass.dump(Vector(1, 2))['__jsonclass__'] ==
+                        ['tests.Vector', [1, 2]])
+        config.serialize_method = 'to_json'
+        self.assertTrue(jsonclass.dump(Vector(1, 2))['__jsonclass__'] ==
+                        ['tests.Vector', []])
+
+    def test_round_trip(self):
+        point = jsonclass.load(jsonclass.dump(Point(1, 2)))
+        self.assertTrue(isinstance(point, Point))
+        self.assertTrue((point.x, point.y) == (1, 2))
+
+    def test_loads(self):
+        from bson import ObjectId
+        oid = ObjectId()
+        data = jsonrpc.dumps(
+            [Point(1, 2), {'_id': oid, 'v': Vector(3, 4)}],
+            methodresponse=True, rpcid=1)
+        for name in ('fast', 'bson'):
+            result = codec.get_codec(name).loads(
+                data, object_hook=jsonclass.object_hook)['result']
+            self.assertTrue(isinstance(result[0], Point))
+            self.assertTrue(result[0].y == 2)
+            self.assertTrue(result[1]['_id'] == oid)
+            self.assertTrue(isinstance(result[1]['v'], Vector))
+        result = jsonrpc.loads(data)['result']
+        self.assertTrue(isinstance(result[1]['v'], Vector))
+
+    def test_dumps(self):
+        when = datetime.datetime(2015, 1, 1)
+        params = [Point(1, 2), {'p': (Point(3, 4),)}, when]
+        for name in ('fast', 'bson'):
+            config.codec = name
+            data = json.loads(jsonrpc.dumps(params, 'method'))
+            self.assertTrue(data['params'][0] == jsonclass.dump(Point(1, 2)))
+            self.assertTrue(data['params'][1]['p'][0]['y'] == 4)
+            self.assertTrue(data['params'][2] == {'$date': 1420070400000})
+        config.codec = 'fast'
+        # The params are left alone
+        self.assertTrue(isinstance(params[1]['p'][0], Point))
+
+    def test_builtin_types_refused(self):
+        for value in (set([1]), object()):
+            with self.assertRaises(TypeError):
+                jsonclass.dump(value)
+            with self.assertRaises(TypeError):
+                jsonclass.default(value)
+
+    def test_type_lists_changed(self):
+        jsonclass.dump(Point(1, 2))
+        jsonclass.other_types.append(Point)
+        try:
+            point = Point(1, 2)
+            self.assertTrue(jsonclass.dump([point])[0] is point)
+            self.assertTrue(jsonclass.load(point) is point)
+        finally:
+            jsonclass.other_types.remove(Point)
+        self.assertTrue('__jsonclass__' in jsonclass.dump(Point(1, 2)))
+
+    def test_load_plain(self):
+        data = {'a': [1, {'b': 'c'}], 'd': None}
+        self.assertTrue(jsonclass.load(data) is data)
+
+    def test_load_copies_only_what_changed(self):
+        data = [{'a': [1]}, {'p': jsonclass.dump(Point(1, 2))}]
+        result = jsonclass.load(data)
+        self.assertTrue(result is not data)
+        self.assertTrue(result[0] is data[0])
+        self.assertTrue(isinstance(result[1]['p'], Point))
+        self.assertTrue(isinstance(data[1]['p'], dict))
+        self.assertTrue(jsonclass.resolved_classes['tests.Point'] is Point)
+
+
+class StreamingServer(ThreadedJSONRPCServer):
+    max_request_size = 1024 * 1024
+
+
+class StreamingRequestTests(unittest.TestCase):
+    """
+    Request bodies bigger than a chunk, parsed as they're read.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.called = Event()
+        self.server = server_set_up(
+            addr=('', self.port), server_class=StreamingServer)
+        self.server.register_function(
+            lambda: self.called.set() or True, 'signal')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, body, parts=1, pause=None, length=None):
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=5)
+        connection.putrequest('POST', '/')
+        connection.putheader('Content-Length', str(length or len(body)))
+        connection.endheaders()
+        step = len(body) / parts + 1
+        for i in range(0, len(body), step):
+            if i and pause:
+                pause()
+            connection.send(body[i:i + step])
+        response = connection.getresponse()
+        content = response.read()
+        connection.close()
+        return response, content
+
+    def batch(self, count, padding='x' * 100):
+        return json.dumps([
+            {'jsonrpc': '2.0', 'method': 'update', 'params': [padding],
+             'id': i} for i in range(count)])
+
+    def test_large_batch(self):
+        response, content = self.post(self.batch(2000), parts=10)
+        self.assertTrue(response.status == 200)
+        result = json.loads(content)
+        self.assertTrue([r['id'] for r in result] == range(2000))
+        self.assertTrue(result[0]['result'] == ['x' * 100])
+
+    def test_entries_dispatched_while_reading(self):
+        first = json.dumps({'jsonrpc': '2.0', 'method': 'signal', 'id': 0})
+        body = '[%s,%s]' % (first, self.batch(1000)[1:-1])
+        seen = []
+        response, content = self.post(
+            body, parts=2,
+            pause=lambda: seen.append(self.called.wait(5)))
+        self.assertTrue(seen == [True])
+        result = json.loads(content)
+        self.assertTrue(result[0]['result'] is True)
+        self.assertTrue(len(result) == 1001)
+
+    def test_invalid_batch(self):
+        body = self.batch(1000)[:-50] + '}}}]'
+        response, content = self.post(body, parts=2)
+        self.assertTrue(json.loads(content)['error']['code'] == -32700)
+
+    def test_too_large(self):
+        # Refused on the headers alone
+        response, content = self.post('', length=2 * 1024 * 1024)
+        self.assertTrue(response.status == 413)
+        self.assertTrue(json.loads(content)['error']['code'] == -32600)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    """
+    Results of repeated calls answered by the client's cache.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.server = server_set_up(addr=('', self.port))
+        self.calls = []
+        self.server.register_function(
+            lambda *args: self.calls.append(args) or len(self.calls),
+            'lookup')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_client(self, cache):
+        return Server('http://localhost:%d' % self.port, cache=cache)
+
+    def test_cached_call(self):
+        cache = ResponseCache(methods={'lookup': 60})
+        client = self.get_client(cache)
+        self.assertTrue(client.lookup('a') == 1)
+        self.assertTrue(client.lookup('a') == 1)
+        self.assertTrue(client.lookup('b') == 2)
+        self.assertTrue(client.add(1, 2) == 3)
+        self.assertTrue(client.add(1, 2) == 3)
+        self.assertTrue(len(self.calls) == 2)
+        self.assertTrue(cache.stats() == {
+            'hits': 1, 'misses': 2, 'evictions': 0, 'size': 2,
+            'bytes': 0})
+        self.assertTrue(cache.stats('lookup') == {'hits': 1, 'misses': 2})
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        client = self.get_client(cache)
+        client.lookup('a')
+        client.lookup('b')
+        cache.invalidate('lookup', ['a'])
+        self.assertTrue(client.lookup('a') == 3)
+        self.assertTrue(client.lookup('b') == 2)
+        cache.invalidate('lookup')
+        self.assertTrue(client.lookup('b') == 4)
+        cache.invalidate()
+        self.assertTrue(len(cache) == 0)
+
+    def test_errors_not_cached(self):
+        cache = ResponseCache()
+        client = self.get_client(cache)
+        for i in range(2):
+            with self.assertRaises(ProtocolError):
+                client.nothing()
+        self.assertTrue(len(cache) == 0)
+
+    def test_expiry_and_eviction(self):
+        cache = ResponseCache(
+            max_size=2, ttl=60, methods={'a': None, 'b': 0.01, 'c': None})
+        cache.call('a', [1], lambda: 'a')
+        cache.call('b', [1], lambda: 'b')
+        time.sleep(0.02)
+        self.assertTrue(cache.call('b', [1], lambda: 'new') == 'new')
+        cache.call('c', [1], lambda: 'c')
+        self.assertTrue(cache.evictions == 1)
+        self.assertTrue(cache.call('a', [1], lambda: 'new') == 'new')
+        self.assertTrue(cache.call('d', [1], lambda: 'd') == 'd')
+        self.assertTrue(len(cache) == 2)
+        cache = ResponseCache(ttl=60)
+        cache.call('f', {'x': 1, 'y': [True]}, lambda: 1)
+        self.assertTrue(cache.call('f', {'y': [True], 'x': 1}, None) == 1)
+        self.assertTrue(cache.call('f', {'y': [1], 'x': 1}, lambda: 2) == 2)
+
+
+class CountingService(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    @cached(ttl=60)
+    def lookup(self, key):
+        self.calls += 1
+        return {'key': key, 'calls': self.calls}
+
+
+class ServerCacheTests(unittest.TestCase):
+    """
+    Serialized results of cacheable methods kept by the dispatcher.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.server = server_set_up(addr=('', self.port))
+        self.service = CountingService()
+        self.server.register_function(self.service.lookup, 'lookup')
+        self.server.register_function(
+            self.service.lookup, 'lookup_once', cache_ttl=0.01)
+        self.server.register_function(
+            lambda: jsonrpc.Fault(-32000, 'Nope'), 'fail', cache_ttl=60)
+        self.server.register_function(
+            self.service.lookup, 'lookup_coalesced', coalesce=True)
+        self.server.register_function(
+            lambda x: x * 3, 'triple', cache_ttl=60)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_client(self):
+        return Server('http://localhost:%d' % self.port)
+
+    def test_cached_method(self):
+        client = self.get_client()
+        self.assertTrue(client.lookup('a') == {'key': 'a', 'calls': 1})
+        self.assertTrue(client.lookup('a') == {'key': 'a', 'calls': 1})
+        self.assertTrue(client.lookup(key='b') == {'key': 'b', 'calls': 2})
+        cache = self.server.response_cache
+        self.assertTrue(cache.stats('lookup') == {'hits': 1, 'misses': 2})
+        self.assertTrue(cache.stats()['bytes'] == len(
+            '{"key": "a", "calls": 1}{"key": "b", "calls": 2}'))
+
+    def test_expiry_and_faults(self):
+        client = self.get_client()
+        client.lookup_once('a')
+        time.sleep(0.02)
+        self.assertTrue(client.lookup_once('a')['calls'] == 2)
+        for i in range(2):
+            with self.assertRaises(ProtocolError):
+                client.fail()
+        self.assertTrue(self.server.response_cache.stats('fail') == {
+            'hits': 0, 'misses': 2})
+
+    def test_cache_size_set_after_init(self):
+        self.server.cache_size = 1
+        client = self.get_client()
+        client.lookup('a')
+        client.lookup('b')
+        self.assertTrue(self.server.response_cache.max_size == 1)
+        self.assertTrue(len(self.server.response_cache) == 1)
+
+    def test_cached_while_coalescing(self):
+        flight = self.server.single_flight
+        call = flight.call
+
+        def finish_first(*args):
+            # An identical call misses the cache too, and finishes first
+            flight.call = call
+            self.server._dispatch('lookup_coalesced', ['a'])
+            return call(*args)
+        flight.call = finish_first
+        result = self.get_client().lookup_coalesced('a')
+        self.assertTrue(result == {'key': 'a', 'calls': 1})
+        self.assertTrue(self.service.calls == 1)
+
+    def test_int_and_float_params(self):
+        client = self.get_client()
+        self.assertTrue(client.triple(1) == 3)
+        result = client.triple(1.0)
+        self.assertTrue(result == 3.0 and isinstance(result, float))
+        cache = self.server.response_cache
+        self.assertTrue(cache.key('triple', [1]) != cache.key('triple', [1.0]))
+        self.assertTrue(cache.stats('triple') == {'hits': 0, 'misses': 2})
+
+    def test_coalesced_stats(self):
+        client = self.get_client()
+        client.lookup_coalesced('a')
+        client.lookup_coalesced('a')
+        self.assertTrue(
+            self.server.response_cache.stats('lookup_coalesced') ==
+            {'hits': 1, 'misses': 1})
+
+    def test_memory_cap(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.set(('a', ()), 'a', 60, size=6)
+        cache.set(('b', ()), 'b', 60, size=6)
+        cache.set(('c', ()), 'c', 60, size=11)
+        self.assertTrue(cache.stats()['bytes'] == 6)
+        self.assertTrue(cache.get(('b', ())) == 'b')
+        self.assertTrue(cache.evictions == 1)
+
+
+class CoalescingTests(unittest.TestCase):
+    """
+    Identical calls that come in together run once.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.release = Event()
+        self.calls = []
+        self.server = ThreadedJSONRPCServer(('', self.port), logRequests=False)
+        self.server.register_function(self.expensive, 'expensive',
+                                      coalesce=True)
+        server_proc = Thread(target=self.server.serve_forever)
+        server_proc.daemon = True
+        server_proc.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expensive(self, key):
+        self.calls.append(key)
+        self.release.wait(10)
+        return key * 2
+
+    def call(self, key, results):
+        client = Server('http://localhost:%d' % self.port)
+        results.append(client.expensive(key))
+
+    def test_coalesced(self):
+        results = []
+        threads = [Thread(target=self.call, args=(key, results))
+                   for key in (1, 1, 1, 1, 2)]
+        for thread in threads:
+            thread.start()
+        for i in range(100):
+            if self.server.single_flight.coalesced == 3 and \
+                    len(self.calls) == 2:
+                break
+            time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(sorted(self.calls) == [1, 2])
+        self.assertTrue(sorted(results) == [2, 2, 2, 2, 4])
+        # Not coalesced once it's done
+        self.call(1, results)
+        self.assertTrue(self.calls == [1, 2, 1] or self.calls == [2, 1, 1])
+
+    def test_exception_shared(self):
+        flight = SingleFlight()
+        errors = []
+
+        def fail():
+            self.release.wait(5)
+            raise ValueError('Nope')
+
+        def call():
+            try:
+                flight.call('key', fail)
+            except ValueError, e:
+                errors.append(e)
+        threads = [Thread(target=call) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for i in range(100):
+            if flight.coalesced == 1:
+                break
+            time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(len(errors) == 2 and errors[0] is errors[1])
+
+
+class QuickBreaker(CircuitBreaker):
+    base_backoff = 0.02
+    probe_interval = 10
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    """
+    Servers of a pool checked in the background, and skipped when down.
+    """
+
+    def setUp(self):
+        self.port = get_port()
+        self.dead_port = get_port()
+        self.server = server_set_up(addr=('', self.port))
+        self.pool = ConnectionPool({
+            'service': [('localhost', self.dead_port),
+                        ('localhost', self.port)],
+            'offline': [('localhost', self.dead_port)],
+        }, transport_method='heisen', user='test', check_interval=0.05)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for_check(self):
+        for i in range(100):
+            if self.pool.black_list['offline']:
+                return
+            time.sleep(0.05)
+
+    def test_dead_server_skipped(self):
+        self.wait_for_check()
+        for i in range(4):
+            connection = self.pool.get_available_server('service')
+            self.assertTrue(connection.port == self.port)
+        self.assertTrue(self.pool.service.add(2, 3) == 5)
+
+    def test_proxy_reused(self):
+        self.wait_for_check()
+        connection = self.pool.get_available_server('service')
+        self.assertTrue(self.pool.service is self.pool.service)
+        results = []
+
+        def call(i):
+            results.append(self.pool.service.add(i, 1))
+        threads = [Thread(target=call, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(sorted(results) == range(1, 9))
+        self.assertTrue(0 < len(connection.transports.idle) <= 4)
+        self.pool.add_server('other', ('localhost', self.port))
+        self.assertTrue(
+            self.pool.get_available_server('service') is connection)
+
+    def test_load_recorded(self):
+        self.wait_for_check()
+        connection = self.pool.get_available_server('service')
+        self.pool.service.add(1, 2)
+        self.assertTrue(connection.requests == 1)
+        self.assertTrue(connection.outstanding == 0)
+        self.assertTrue(connection.latency > 0)
+
+    def test_balancers(self):
+        first, second = [
+            Connection('heisen', 'test', 'localhost', port, weight=weight)
+            for port, weight in ((1, 3), (2, 1))]
+        connections = [first, second]
+        balancer = get_balancer('weighted_round_robin')()
+        picks = [balancer.choose(connections) for i in range(8)]
+        self.assertTrue(picks.count(first) == 6)
+        self.assertTrue(picks[:4].count(second) == 1)
+        first.outstanding = 2
+        balancer = get_balancer('least_outstanding')()
+        self.assertTrue(balancer.choose(connections) is second)
+        first.outstanding = 0
+        second.started()
+        second.finished(0.5)
+        for name in ('peak_ewma', 'power_of_two_choices'):
+            balancer = get_balancer(name)()
+            self.assertTrue(balancer.choose(connections) is first)
+        with self.assertRaises(ValueError):
+            get_balancer('random')
+
+    def test_circuit_breaker(self):
+        breaker = QuickBreaker()
+        for failed in (True, False, True, False, False):
+            breaker.record(failed)
+        self.assertTrue(breaker.state == 'closed')
+        breaker.record(True)
+        self.assertTrue(breaker.state == 'open')
+        self.assertTrue(not breaker.available())
+        time.sleep(0.03)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.state == 'half_open')
+        # One probe at a time
+        self.assertTrue(not breaker.allow())
+        breaker.record(True)
+        self.assertTrue(breaker.trips == 2)
+        time.sleep(0.05)
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        self.assertTrue(breaker.state == 'closed' and breaker.trips == 0)
+
+    def test_failing_server_left_out(self):
+        self.wait_for_check()
+        connection = self.pool.get_available_server('service')
+        for i in range(5):
+            connection.breaker.record(True)
+        with self.assertRaises(NoServer):
+            self.pool.get_available_server('service')
+
+    def test_all_down(self):
+        self.wait_for_check()
+        with self.assertRaises(NoServer):
+            self.pool.get_available_server('offline')
+
+
+class HedgingTests(unittest.TestCase):
+    """
+    Calls the first server is slow to answer sent to another one too.
+    """
+
+    def setUp(self):
+        self.ports = [get_port(), get_port()]
+        self.servers = [server_set_up(addr=('', port)) for port in self.ports]
+        self.servers[0].register_function(
+            lambda: time.sleep(0.5) or 'slow', 'lookup')
+        self.servers[1].register_function(lambda: 'fast', 'lookup')
+        self.pool = ConnectionPool({
+            'service': [('localhost', port) for port in self.ports],
+        }, transport_method='heisen', user='test', check_interval=None,
+            hedge_methods=['lookup'])
+
+    def tearDown(self):
+        self.pool.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_hedged(self):
+        for i in range(2):
+            start = time.time()
+            self.assertTrue(self.pool.service.lookup() == 'fast')
+            self.assertTrue(time.time() - start < 0.4)
+        hedger = self.pool.get_hedging_proxy('service')
+        self.assertTrue(hedger.calls == 2 and hedger.hedges == 1)
+        # Not hedged
+        self.assertTrue(self.pool.service.add(1, 2) == 3)
+        self.assertTrue(hedger.calls == 2)
+
+    def test_only_backup_on_pool(self):
+        hedger = self.pool.get_hedging_proxy('service')
+        submitted = []
+        submit = self.pool.hedge_pool.submit
+        self.pool.hedge_pool.submit = \
+            lambda *args: submitted.append(args) or submit(*args)
+        for i in range(2):
+            self.assertTrue(self.pool.service.lookup() == 'fast')
+        self.assertTrue(len(submitted) == hedger.hedges == 1)
+
+    def test_not_hedged_calls(self):
+        self.pool.service._notify.add(1, 2)
+        self.assertTrue(json.loads(history.request)['method'] == 'add')
+        batch = MultiCall(self.pool.service)
+        batch.add(1, 2)
+        batch.add(2, 3)
+        self.assertTrue(list(batch()) == [3, 5])
+
+    def test_budget(self):
+        hedger = self.pool.get_hedging_proxy('service')
+        hedger.tokens = 0
+        start = time.time()
+        self.assertTrue(self.pool.service.lookup() == 'slow')
+        self.assertTrue(time.time() - start >= 0.5)
+        self.assertTrue(hedger.hedges == 0)
+
+
+class CodecTests(unittest.TestCase):
+    """
+    The fast codec has to produce the same documents as the bson
+    codec, with or without special types in the payload.
+    """
+
+    def test_plain_payload(self):
+        payload = {'result': [1, 2.5, 'three', None, True], 'id': 'x'}
+        fast = codec.get_codec('fast')
+        bson = codec.get_codec('bson')
+        self.assertTrue(fast.dumps(payload) == bson.dumps(payload))
+        data = bson.dumps(payload)
+        self.assertTrue(fast.loads(data) == bson.loads(data))
+
+    def test_special_payload(self):
+        from bson import ObjectId
+        payload = {
+            'result': [ObjectId(), datetime.datetime(2015, 1, 1)],
+            'id': 'x'
+        }
+        fast = codec.get_codec('fast')
+        bson = codec.get_codec('bson')
+        data = fast.dumps(payload)
+        self.assertTrue(json.loads(data) == json.loads(bson.dumps(payload)))
+        self.assertTrue(fast.loads(data) == bson.loads(data))
+        self.assertTrue(fast.loads(data)['result'][0] ==
+                        payload['result'][0])
+
+    def test_iterables(self):
+        payload = {'result': set([1]), 'gen': (i for i in range(2))}
+        data = codec.get_codec('fast').dumps(payload)
+        self.assertTrue(json.loads(data) == {'result': [1], 'gen': [0, 1]})
+        config.use_jsonclass = False
+        try:
+            data = jsonrpc.dumps([set([1]), (i for i in range(2))], 'method')
+        finally:
+            config.use_jsonclass = True
+        self.assertTrue(json.loads(data)['params'] == [[1], [0, 1]])
+        data = jsonrpc.dumps([set([1])], 'method')
+        self.assertTrue(json.loads(data)['params'] == [[1]])
+
+    def test_plain_codec(self):
+        class Plain(object):
+            def dumps(self, obj):
+                return json.dumps(obj)
+
+            def loads(self, data):
+                return json.loads(data)
+        codec.register_codec('plain', Plain())
+        config.codec = 'plain'
+        try:
+            data = jsonrpc.dumps([Point(1, 2)], 'method')
+            self.assertTrue(json.loads(data)['params'][0] ==
+                            jsonclass.dump(Point(1, 2)))
+            result = jsonrpc.loads(data)['params'][0]
+        finally:
+            config.codec = 'fast'
+            del codec.registry['plain']
+        self.assertTrue(isinstance(result, Point))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            codec.get_codec('foobar')
+
+
 class ExampleService(object):
     @staticmethod
     def subtract(minuend, subtrahend):
@@ -449,6 +1914,14 @@ class ExampleService(object):
     def ping():
         return True
 
+    @staticmethod
+    def get_raw_data():
+        return RawJSON('["hello", 5]')
+
+    @staticmethod
+    def get_raw_unicode():
+        return RawJSON(u'["caf\xe9"]')
+
 
 class ExampleAggregateService(ExampleService):
     """
@@ -458,14 +1931,15 @@ class ExampleAggregateService(ExampleService):
         self.sub_service = ExampleService()
 
 
-def server_set_up(addr, address_family=socket.AF_INET):
+def server_set_up(addr, address_family=socket.AF_INET,
+                  server_class=SimpleJSONRPCServer):
     # Not sure this is a good idea to spin up a new server thread
     # for each test... but it seems to work fine.
     def log_request(self, *args, **kwargs):
         """ Making the server output 'quiet' """
         pass
     SimpleJSONRPCRequestHandler.log_request = log_request
-    server = SimpleJSONRPCServer(addr, address_family=address_family)
+    server = server_class(addr, address_family=address_family)
     service = ExampleAggregateService()
     # Expose an instance of the service
     server.register_instance(service, allow_dotted_names=True)
@@ -476,4 +1950,4 @@ def server_set_up(addr, address_family=socket.AF_INET):
     server_proc = Thread(target=server.serve_forever)
     server_proc.daemon = True
     server_proc.start()
-    return server_proc
+    return server